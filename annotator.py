@@ -0,0 +1,1689 @@
+#!/usr/bin/env python
+"""Galaxy annotation of images (library of 'galaxy-annotator.py').
+
+Annotator loads a catalog (galaxies.json or binary catalog) and a style
+once and annotates images solved by astrometry.net:
+
+    from annotator import Annotator
+    annotator = Annotator('galaxies.json', 'style.json',
+                          auto_label_position=True)
+    svg = annotator.annotate('wcs.fits', 'image.jpg')
+    annotator.write('wcs.fits', 'image.jpg', 'out.png')
+
+Options of Annotator are the same as the command line options of the
+script (see DEFAULT_OPTIONS).
+"""
+import sys
+import os
+import os.path
+import io
+import math
+import json
+import copy
+import re
+import time
+import base64
+import shutil
+import hashlib
+import unicodedata
+from types import SimpleNamespace
+from functools import reduce
+from galaxy_catalog import load_catalog
+
+SVG_LENGTH_PROPS = [ 'baseline-shift', 'font-size', 'kerning', 'letter-spacing',
+                     'stroke-dashoffset', 'stroke-width', 'stroke-width',
+                     'word-spacing' ]
+
+non_svg_marker_style_defaults = {
+    'size': 1.5,
+    'min-size': None,
+    'min-r': 15,
+    'min-size-r': None,
+    'x-margin': 4,
+    'y-margin': 0,
+    'label-position': 'top-right',
+    'label-vertical-align': 'auto'
+}
+non_svg_desc_style_defaults = {
+    'line-height': 1
+}
+DEFAULT_STYLE = {
+    'marker': {
+        'fill': 'none',
+        'stroke': 'gray',
+        'stroke-width': 1
+    },
+    'name': {
+        'font-size': 40,
+        'fill': 'gray',
+        'direction': 'ltr'
+    },
+    'desc': [
+        {
+            'font-size': 40,
+            'fill': 'gray',
+            'direction': 'ltr'
+        }
+    ]
+}
+DEFAULT_STYLE['marker'].update(non_svg_marker_style_defaults)
+
+def update_style(s, s_diff):
+    for key in iter(s):
+        if not key in s_diff:
+            continue
+        v = s[key]
+        if type(v) == dict:
+            v.update(s_diff[key]) 
+        elif type(v) == list:
+            for i, e in enumerate(s_diff[key]):
+                if len(v) > i:
+                    v[i].update(e)
+                else:
+                    v.append(e)
+        else:
+            s[key] = s_diff[key]
+    for ds in s['desc']:
+        for k in non_svg_desc_style_defaults:
+            if not(k in ds):
+                ds[k] = non_svg_desc_style_defaults[k]
+
+def s_to_ss(selector, s):
+    ss = selector + ' {\n' if selector else ''
+    for prop in s:
+        if prop in non_svg_marker_style_defaults:
+            continue
+        if prop in non_svg_desc_style_defaults:
+            continue
+        v = s[prop]
+        ss += "  " + prop + ": "
+        if (type(v) == int or type(v) == float) and prop in SVG_LENGTH_PROPS:
+            ss += "{}px".format(v)
+        elif type(v) == str and prop == 'font-family':
+            ss += '\"{}\"'.format(v)
+        else:
+            ss += str(v)
+        ss += ';\n' if selector else ';'
+    if selector:
+        ss += '}\n'
+    return ss
+
+IMAGE_MAGIC_NUMBERS = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'BM', 'image/bmp')
+]
+def get_image_mime(file):
+    with open(file, 'rb') as f:
+        header = f.read(16)
+    for magic, mime in IMAGE_MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return mime
+    if header[0:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    import mimetypes
+    return mimetypes.guess_type(file)[0] or ''
+
+POS_RE = re.compile('(top|middle|bottom)-(left|middle|right)')
+def parse_label_position(value, file):
+    res = POS_RE.match(value)
+    if not(res):
+        print('{}: ERROR: "label-position" of "marker" '\
+              'is invalid.'.format(file), file=sys.stderr)
+        sys.exit(1)
+    else:
+        return [res.group(2), res.group(1)]
+
+def get_label_anchor(xpos):
+    # TBD: label_anchor for rtl language.
+    if xpos == 'left':
+        return 'end'
+    elif xpos == 'right':
+        return 'start'
+    elif xpos == 'middle':
+        return 'middle'
+
+VALIGN_RE = re.compile('(auto|baseline|top|middle|bottom)')
+def parse_label_valign(value, file):
+    res = VALIGN_RE.match(value)
+    if not(res):
+        print('{}: ERROR: "label-vertical-align" of "marker" '\
+              'is invalid.'.format(file), file=sys.stderr)
+        sys.exit(1)
+    else:
+        return res.group(1)    
+
+DEBUG_STYLE_SHEET = '''
+.debug_marker { fill: none; stroke: white; stroke-width: 2px; stroke-opacity: 0.8; }
+.debug_margin { fill: none; stroke: white; stroke-width: 1.5px; stroke-opacity: 0.8; stroke-dasharray: 8;}
+.debug_centerline { fill: none; stroke: white; stroke-width: 1.5px; stroke-opacity: 0.6; stroke-dasharray: 8 4;}
+.debug_baseline { fill: none; stroke: white; stroke-width: 1.5px; stroke-opacity: 0.8; stroke-dasharray: 16;}
+.debug_middleline { fill: none; stroke: white; stroke-width: 1.5px; stroke-opacity: 0.6; stroke-dasharray: 8 4;}
+.debug_label { fill: none; stroke: white; stroke-width: 2px; stroke-opacity: 0.8; }
+'''
+
+def load_style(style_json, debug=False):
+    style = copy.deepcopy(DEFAULT_STYLE)
+    with open(style_json, 'r', encoding='utf-8') as f:
+        update_style(style, json.load(f))
+
+    if not (type(style['name']['font-size']) == int or
+            type(style['name']['font-size']) == float):
+        print('{}: ERROR: "font-size" of "name" '\
+              'must be of numeric type.'.format(style_json), file=sys.stderr)
+        sys.exit(1)
+    for i, desc in enumerate(style['desc']):
+        if not (type(desc['font-size']) == int or
+                type(desc['font-size']) == float):
+            print('{}: ERROR: "font-size" of "desc"[{}] must be of '\
+                  'numeric type.'.format(style_json, i), file=sys.stderr)
+            sys.exit(1)
+
+    parse_label_valign(style['marker']['label-vertical-align'], style_json)
+    def_label_position = style['marker']['label-position']
+    def_x_pos, def_y_pos = parse_label_position(def_label_position, style_json)
+    def_label_anchor = get_label_anchor(def_x_pos)
+    if not('text-anchor' in style['name']):
+        style['name']['text-anchor'] = def_label_anchor
+
+    style_sheet = "\n"
+    style_sheet += s_to_ss('ellipse.marker', style['marker'])
+    style_sheet += s_to_ss('text.name', style['name'])
+    for i, desc in enumerate(style['desc']):
+        if not('text-anchor' in desc):
+            desc['text-anchor'] = def_label_anchor
+        style_sheet += s_to_ss('text.desc{}'.format(i), desc)
+    if debug:
+        style_sheet += DEBUG_STYLE_SHEET
+    return style, style_sheet
+
+class GalaxyStyle:
+    """Style of galaxies resolved for drawing.
+
+    Holds everything the drawing loop needs from the style: label position,
+    marker parameters, label metrics and inline style sheets of the
+    per-galaxy style (None if not overridden).
+    """
+    __slots__ = ('x_pos', 'y_pos', 'label_valign', 'x_margin', 'y_margin',
+                 'size', 'min_r', 'min_size_r', 'min_size',
+                 'name_height', 'desc_height', 'desc_font_sizes',
+                 'desc_line_heights', 'marker_ss', 'name_ss', 'desc_ss',
+                 'marker_props', 'name_props', 'desc_props')
+
+    def __init__(self, style, s, n_descs, file):
+        x_pos, y_pos = parse_label_position(style['marker']['label-position'],
+                                            file)
+        gal_style = style
+        marker_ss = None
+        name_ss = None
+        desc_ss = None
+        if s is not None:
+            s = copy.deepcopy(s)
+            gal_style = copy.deepcopy(style)
+            s_label_position = None
+            if 'marker' in s:
+                s_label_position = s['marker']['label-position'] \
+                                   if ('label-position' in s['marker']) else None
+                if s_label_position:
+                    x_pos, y_pos = parse_label_position(s_label_position, file)
+                    label_anchor = get_label_anchor(x_pos)
+                    if not('name' in s):
+                        s['name'] = {}
+                    if not('desc' in s):
+                        s['desc'] = []
+                    for i in range(len(s['desc']), n_descs):
+                        s['desc'].append({})
+                marker_ss = s_to_ss(None, s['marker'])
+            if 'name' in s:
+                if not('text-anchor' in s['name']) and s_label_position:
+                    s['name']['text-anchor'] = label_anchor
+                name_ss = s_to_ss(None, s['name'])
+            if 'desc' in s:
+                desc_ss = []
+                for i, desc in enumerate(s['desc']):
+                    if not('text-anchor' in desc) and s_label_position:
+                        desc['text-anchor'] = label_anchor
+                    desc_ss.append(s_to_ss(None, desc))
+            update_style(gal_style, s)
+
+        label_valign = gal_style['marker']['label-vertical-align']
+        parse_label_valign(label_valign, file)
+        if label_valign == 'auto':
+            label_valign = 'baseline'
+            if x_pos == 'middle':
+                if y_pos == 'top':
+                    label_valign = 'bottom'
+                elif y_pos == 'bottom':
+                    label_valign = 'top'
+
+        m = gal_style['marker']
+        self.x_pos = x_pos
+        self.y_pos = y_pos
+        self.label_valign = label_valign
+        self.x_margin = float(m['x-margin'])
+        self.y_margin = float(m['y-margin'])
+        self.size = float(m['size'])
+        self.min_r = m['min-r']
+        self.min_size_r = m['min-size-r'] or (m['min-r'] + 1)
+        self.min_size = m['min-size'] or float(m['size'])
+        self.name_height = float(gal_style['name']['font-size'])
+        self.desc_height = reduce(lambda h, desc: \
+                                  h + desc['font-size'] * desc['line-height'],\
+                                  gal_style['desc'], 0)
+        self.desc_font_sizes = tuple(float(desc['font-size'])
+                                     for desc in gal_style['desc'])
+        self.desc_line_heights = tuple(desc['font-size'] * desc['line-height']
+                                       for desc in gal_style['desc'])
+        self.marker_ss = marker_ss
+        self.name_ss = name_ss
+        self.desc_ss = tuple(desc_ss) if desc_ss is not None else None
+        # resolved style properties (for raster output).
+        self.marker_props = gal_style['marker']
+        self.name_props = gal_style['name']
+        self.desc_props = gal_style['desc']
+
+    def label_origin(self, x, y, dx, dy):
+        """Position of 'name' of the label of the marker (x, y, dx, dy)."""
+        if self.x_pos == 'left':
+            name_x = x - dx - self.x_margin
+        elif self.x_pos == 'right':
+            name_x = x + dx + self.x_margin
+        elif self.x_pos == 'middle':
+            name_x = x
+
+        # y of 'name' baseline 
+        if self.y_pos == 'top':
+            name_y = y - dy - self.y_margin
+        elif self.y_pos == 'bottom':
+            name_y = y + dy + self.y_margin
+        elif self.y_pos == 'middle':
+            name_y = y
+
+        if self.label_valign == 'top':
+            name_y += self.name_height
+        elif self.label_valign == 'bottom':
+            name_y -= self.desc_height
+        elif self.label_valign == 'middle':
+            name_y += self.name_height - \
+                (self.name_height + self.desc_height) / 2
+        return name_x, name_y
+
+    def label_box(self, gal, name_x, name_y):
+        """Estimated box (x0, y0, x1, y1) of the label of gal."""
+        width = text_width(gal['name'], self.name_height)
+        for i, desc in enumerate(gal['descs']):
+            if i < len(self.desc_font_sizes):
+                width = max(width, text_width(desc, self.desc_font_sizes[i]))
+        if self.x_pos == 'left':
+            x0 = name_x - width
+        elif self.x_pos == 'right':
+            x0 = name_x
+        else:
+            x0 = name_x - width / 2
+        return (x0, name_y - self.name_height,
+                x0 + width, name_y + self.desc_height)
+
+def text_width(text, font_size):
+    # rough estimate: 1em for full width characters, 0.6em for others.
+    return font_size * sum(1.0 if unicodedata.east_asian_width(c) in 'WF'
+                           else 0.6 for c in text)
+
+class StyleCache:
+    """Resolves GalaxyStyle of galaxies.
+
+    The default style is resolved once, and per-galaxy styles are memoized
+    by their content so galaxies with the same "style" share one
+    GalaxyStyle (and its style sheet strings).
+    """
+    def __init__(self, style, file):
+        self.style = style
+        self.file = file
+        self.default = GalaxyStyle(style, None, 0, file)
+        self.styles = {}
+
+    def get(self, gal):
+        if not('style' in gal):
+            return self.default
+        key = (json.dumps(gal['style'], sort_keys=True), len(gal['descs']))
+        gal_style = self.styles.get(key)
+        if gal_style is None:
+            gal_style = GalaxyStyle(self.style, gal['style'],
+                                    len(gal['descs']), self.file)
+            self.styles[key] = gal_style
+        return gal_style
+
+    def get_at(self, gal, label_position):
+        """GalaxyStyle of gal with its label at label_position."""
+        s = copy.deepcopy(gal.get('style', {}))
+        s.setdefault('marker', {})['label-position'] = label_position
+        return self.get({ 'style': s, 'descs': gal['descs'] })
+
+class SpatialGrid:
+    """Uniform grid of boxes (x0, y0, x1, y1) for overlap queries."""
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.boxes = []
+
+    def _cells(self, box):
+        c = self.cell_size
+        for cx in range(math.floor(box[0] / c), math.floor(box[2] / c) + 1):
+            for cy in range(math.floor(box[1] / c), math.floor(box[3] / c) + 1):
+                yield cx, cy
+
+    def add(self, box, owner):
+        self.boxes.append((box, owner))
+        for cell in self._cells(box):
+            self.cells.setdefault(cell, []).append(len(self.boxes) - 1)
+
+    def overlaps(self, box, owner, limit=None):
+        """Number of boxes of other owners overlapping box (counted up to
+        limit)."""
+        found = set()
+        for cell in self._cells(box):
+            for i in self.cells.get(cell, ()):
+                b, o = self.boxes[i]
+                if o != owner and b[0] < box[2] and box[0] < b[2] and \
+                   b[1] < box[3] and box[1] < b[3]:
+                    found.add(i)
+                    if limit is not None and len(found) >= limit:
+                        return len(found)
+        return len(found)
+
+LABEL_POSITIONS = [ 'top-right', 'top-left', 'bottom-right', 'bottom-left',
+                    'middle-right', 'middle-left', 'top-middle',
+                    'bottom-middle', 'middle-middle' ]
+
+def place_labels(gals, gal_styles, styles, gal_x, gal_y, marker_dx, marker_dy,
+                 image_w, image_h):
+    """Choose label positions of galaxies avoiding overlaps.
+
+    Labels are placed in descending order of marker size. Each label takes
+    the first of its own position and LABEL_POSITIONS which overlaps no
+    markers of other galaxies and no labels placed before and is in the
+    image, or the position with the least overlaps. Galaxies whose own
+    "style" has "label-position" keep it. Returns new gal_styles.
+    """
+    gal_styles = list(gal_styles)
+    origins = [ (float(gal_x[i]), float(gal_y[i]),
+                 float(marker_dx[i]), float(marker_dy[i]))
+                for i in range(len(gals)) ]
+    heights = [ gs.name_height + gs.desc_height for gs in gal_styles ]
+    grid = SpatialGrid(max(sorted(heights)[len(heights) // 2], 1.0)
+                       if heights else 1.0)
+    for i, (x, y, dx, dy) in enumerate(origins):
+        grid.add((x - dx, y - dy, x + dx, y + dy), i)
+
+    def place(i, gs):
+        box = gs.label_box(gals[i], *gs.label_origin(*origins[i]))
+        grid.add(box, i)
+
+    fixed = [ 'style' in gal and 'marker' in gal['style'] and
+              'label-position' in gal['style']['marker'] for gal in gals ]
+    for i in range(len(gals)):
+        if fixed[i]:
+            place(i, gal_styles[i])
+    for i in sorted(range(len(gals)), key=lambda i: -origins[i][3]):
+        if fixed[i]:
+            continue
+        gs = gal_styles[i]
+        own = gs.y_pos + '-' + gs.x_pos
+        best = None
+        for pos in [ own ] + [ p for p in LABEL_POSITIONS if p != own ]:
+            cand = gs if pos == own else styles.get_at(gals[i], pos)
+            box = cand.label_box(gals[i], *cand.label_origin(*origins[i]))
+            n = 0
+            if box[0] < 0 or box[1] < 0 or box[2] > image_w or \
+               box[3] > image_h:
+                n += 1
+            n += grid.overlaps(box, i, best[0] - n if best else None)
+            if best is None or n < best[0]:
+                best = (n, cand)
+            if n == 0:
+                break
+        gal_styles[i] = best[1]
+        place(i, best[1])
+    return gal_styles
+
+class SVGWriter:
+    """Adds top level elements to the drawing and saves it.
+
+    In stream mode each element is serialized to the output file as soon
+    as it is added, so only the element being written is kept in memory.
+    An embedded image is base64 encoded chunk by chunk into the output file
+    in both modes. The output is the same as svgwrite.Drawing.save().
+    """
+    XML_HEADER = '<?xml version="1.0" encoding="utf-8" ?>\n'
+    INDENT = 2
+    # base64 characters never include '_', so this can't appear in real data.
+    IMAGE_DATA_PLACEHOLDER = '__IMAGE_DATA__'
+    # multiple of 3 bytes, so that chunks encode without padding.
+    IMAGE_CHUNK_SIZE = 3 * 256 * 1024
+
+    def __init__(self, drawing, stream=False, pretty=True, out=None):
+        self.drawing = drawing
+        self.stream = stream
+        self.pretty = pretty
+        # text file object to write to instead of drawing.filename.
+        self.out = out
+        self.file = None
+        self.image_file = None
+        # parent of added elements and its ancestors (not in stream mode).
+        self.parent = drawing
+        self.parents = []
+        # depth of the current group (in stream mode).
+        self.depth = 1
+        # base64 encoding of the image to copy, and file to save it to.
+        self.image_data_file = None
+        self.save_image_data = None
+        # serialized elements of the current fragment (in stream mode).
+        self.fragment = None
+
+    def embed_image(self, image_file, mime, image_data_file=None,
+                    save_image_data=None):
+        """Embeds image_file. If image_data_file, its content (base64
+        encoding of image_file) is copied instead of encoding image_file.
+        If save_image_data, the encoding is also written to that file."""
+        self.image_file = image_file
+        self.image_data_file = image_data_file
+        self.save_image_data = save_image_data
+        self.drawing.add(self.drawing.image('data:' + mime + ';base64,' +
+                                            self.IMAGE_DATA_PLACEHOLDER))
+
+    def _write_image_data(self):
+        if self.image_data_file:
+            with open(self.image_data_file, encoding='ascii') as f:
+                shutil.copyfileobj(f, self.file, self.IMAGE_CHUNK_SIZE)
+            self.image_file = None
+            return
+        save = None
+        if self.save_image_data:
+            save = open(self.save_image_data, 'w', encoding='ascii')
+        with open(self.image_file, 'rb') as f:
+            while True:
+                chunk = f.read(self.IMAGE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                data = base64.standard_b64encode(chunk).decode()
+                self.file.write(data)
+                if save:
+                    save.write(data)
+        if save:
+            save.close()
+        self.image_file = None
+
+    def _write(self, xml_string):
+        if self.image_file:
+            head, sep, tail = xml_string.partition(self.IMAGE_DATA_PLACEHOLDER)
+            if sep:
+                self.file.write(head)
+                self._write_image_data()
+                xml_string = tail
+        self.file.write(xml_string)
+
+    def _open(self):
+        from svgwrite.utils import pretty_xml
+        # write XML header, svg start tag and elements added so far.
+        xml_string = self.drawing.tostring()
+        if self.pretty:
+            xml_string = pretty_xml(xml_string, indent=self.INDENT)
+        self.file = self.out or open(self.drawing.filename, 'w',
+                                     encoding='utf-8')
+        self.file.write(self.XML_HEADER)
+        if self.stream:
+            xml_string = xml_string[:xml_string.rindex('</svg>')]
+        self._write(xml_string)
+
+    def add(self, element):
+        if not self.stream:
+            self.parent.add(element)
+            return
+        if not self.file:
+            self._open()
+        if self.pretty:
+            from xml.dom import minidom
+            node = minidom.parseString(element.tostring()).documentElement
+            out = io.StringIO()
+            node.writexml(out, indent=' ' * self.INDENT * self.depth,
+                          addindent=' ' * self.INDENT, newl='\n')
+            xml_string = out.getvalue()
+        else:
+            xml_string = element.tostring()
+        if self.fragment is not None:
+            self.fragment.append(xml_string)
+        self.file.write(xml_string)
+
+    def begin_fragment(self):
+        """Records serialized elements added until end_fragment() (in
+        stream mode)."""
+        self.fragment = []
+
+    def end_fragment(self):
+        """Returns the elements recorded since begin_fragment() as text."""
+        fragment = ''.join(self.fragment)
+        self.fragment = None
+        return fragment
+
+    def add_fragment(self, fragment):
+        """Writes a fragment returned by end_fragment() (in stream
+        mode)."""
+        if not self.file:
+            self._open()
+        self.file.write(fragment)
+
+    def begin_group(self, group):
+        """Adds following elements into group until end_group()."""
+        if not self.stream:
+            self.parents.append(self.parent)
+            self.parent.add(group)
+            self.parent = group
+            return
+        if not self.file:
+            self._open()
+        start_tag = group.tostring()
+        start_tag = start_tag[:start_tag.rindex('/>')].rstrip() + '>'
+        if self.pretty:
+            self.file.write(' ' * self.INDENT * self.depth + start_tag + '\n')
+        else:
+            self.file.write(start_tag)
+        self.depth += 1
+
+    def end_group(self):
+        if not self.stream:
+            self.parent = self.parents.pop()
+            return
+        self.depth -= 1
+        if self.pretty:
+            self.file.write(' ' * self.INDENT * self.depth + '</g>\n')
+        else:
+            self.file.write('</g>')
+
+    def close(self):
+        if not self.file:
+            self._open()
+        if self.stream:
+            self.file.write('</svg>\n' if self.pretty else '</svg>')
+        if not self.out:
+            self.file.close()
+
+def content_hash(*values):
+    """SHA-1 of values (str, bytes or JSON serializable values)."""
+    h = hashlib.sha1()
+    for v in values:
+        if isinstance(v, str):
+            v = v.encode('utf-8')
+        elif not isinstance(v, bytes):
+            v = json.dumps(v, sort_keys=True, ensure_ascii=False,
+                           default=repr).encode('utf-8')
+        h.update(len(v).to_bytes(8, 'little'))
+        h.update(v)
+    return h.hexdigest()
+
+def file_hash(file):
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+class AnnotationCache:
+    """Sidecar cache of an SVG output for incremental re-annotation.
+
+    Kept in the directory out_file + '.cache'. The base64 encoding of the
+    image is keyed by the hash of the image file (hashed again only if its
+    size or mtime changed), the projected positions of the galaxies in the
+    image by the hashes of the WCS header and the positions of the catalog,
+    the label positions chosen by place_labels() by the hash of all drawn
+    galaxies, and the SVG fragment of each galaxy by the hashes of the WCS
+    header, the style, the options and the galaxy. Only entries used by the
+    last run are kept by save().
+    """
+    # 2: min-r of markers is written as in the style.
+    VERSION = 2
+
+    def __init__(self, out_file):
+        self.dir = out_file + '.cache'
+        self.index = {}
+        self.fragments = {}
+        try:
+            with open(self._path('index.json'), encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('version') == self.VERSION:
+                with open(self._path('fragments.json'), encoding='utf-8') as f:
+                    self.fragments = json.load(f)
+                self.index = index
+        except (OSError, ValueError):
+            pass
+        self.new_index = { 'version': self.VERSION }
+        self.new_fragments = {}
+        self.new_projection = None
+        self.new_image_data = None
+        self.hits = 0
+
+    def _path(self, name):
+        return os.path.join(self.dir, name)
+
+    def image_data(self, image_file):
+        """Returns the cached base64 encoding file of image_file (or None)
+        and the file to save the encoding to (or None)."""
+        st = os.stat(image_file)
+        stamp = [ os.path.abspath(image_file), st.st_size, st.st_mtime_ns ]
+        image = self.index.get('image', {})
+        if image.get('stamp') == stamp:
+            digest = image['hash']
+        else:
+            digest = file_hash(image_file)
+        self.new_index['image'] = { 'stamp': stamp, 'hash': digest }
+        if image.get('hash') == digest and \
+           os.path.exists(self._path('image.b64')):
+            return self._path('image.b64'), None
+        os.makedirs(self.dir, exist_ok=True)
+        self.new_image_data = self._path('image.b64.part')
+        return None, self.new_image_data
+
+    def projection(self, key):
+        """Cached (n_candidates, visible, gal_x, gal_y) of key or None."""
+        import numpy as np
+        self.new_index['projection'] = key
+        if self.index.get('projection') != key:
+            return None
+        try:
+            with np.load(self._path('projection.npz')) as data:
+                return (int(data['n_candidates']), data['visible'],
+                        data['gal_x'], data['gal_y'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put_projection(self, n_candidates, visible, gal_x, gal_y):
+        self.new_projection = (n_candidates, visible, gal_x, gal_y)
+
+    def labels(self, key):
+        """Cached label positions of galaxies of key or None."""
+        self.new_index['labels'] = { 'key': key }
+        labels = self.index.get('labels', {})
+        if labels.get('key') != key:
+            return None
+        self.new_index['labels'] = labels
+        return labels['positions']
+
+    def put_labels(self, positions):
+        self.new_index['labels']['positions'] = positions
+
+    def fragment(self, key):
+        """Cached SVG fragment of key or None."""
+        fragment = self.fragments.get(key)
+        if fragment is not None:
+            self.new_fragments[key] = fragment
+            self.hits += 1
+        return fragment
+
+    def put_fragment(self, key, fragment):
+        self.new_fragments[key] = fragment
+
+    def save(self):
+        import numpy as np
+        os.makedirs(self.dir, exist_ok=True)
+        # the old index is removed first and the new one is written last, so
+        # an interrupted save is never used.
+        if os.path.exists(self._path('index.json')):
+            os.remove(self._path('index.json'))
+        if self.new_image_data:
+            os.replace(self.new_image_data, self._path('image.b64'))
+        if self.new_projection:
+            n_candidates, visible, gal_x, gal_y = self.new_projection
+            with open(self._path('projection.npz.part'), 'wb') as f:
+                np.savez(f, n_candidates=n_candidates, visible=visible,
+                         gal_x=gal_x, gal_y=gal_y)
+            os.replace(self._path('projection.npz.part'),
+                       self._path('projection.npz'))
+        with open(self._path('fragments.json.part'), 'w',
+                  encoding='utf-8') as f:
+            json.dump(self.new_fragments, f, ensure_ascii=False)
+        os.replace(self._path('fragments.json.part'),
+                   self._path('fragments.json'))
+        with open(self._path('index.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.new_index, f)
+
+RASTER_EXTENSIONS = { '.png': 'PNG', '.jpg': 'JPEG', '.jpeg': 'JPEG' }
+
+def raster_format(file):
+    return RASTER_EXTENSIONS.get(os.path.splitext(file)[1].lower())
+
+class NullWriter:
+    """SVGWriter which writes nothing (for output without SVG)."""
+    def embed_image(self, image_file, mime):
+        pass
+
+    def add(self, element):
+        pass
+
+    def begin_group(self, group):
+        pass
+
+    def end_group(self):
+        pass
+
+    def close(self):
+        pass
+
+CSS_NUMBER_RE = re.compile(r'\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?)'
+                           r'\s*(px|%)?\s*$', re.IGNORECASE)
+def css_number(value, default):
+    """Number of a CSS value of the style (e.g. 3, '3px', '0.5' or '50%'
+    for 0.5), or default if it can't be parsed."""
+    if type(value) == int or type(value) == float:
+        return value
+    res = CSS_NUMBER_RE.match(str(value))
+    if not(res):
+        return default
+    number = float(res.group(1))
+    return number / 100 if res.group(2) == '%' else number
+
+class RasterWriter:
+    """Draws markers and labels onto the image with Pillow.
+
+    Takes the same geometry as the SVG elements and the resolved style
+    properties of GalaxyStyle. Annotations are drawn on a transparent layer
+    composited over the image on save(), so opacities of the style apply.
+    """
+    def __init__(self, image_file, out_file, font_file=None):
+        try:
+            from PIL import Image, ImageDraw
+        except ImportError:
+            print('ERROR: Pillow is required for PNG/JPEG output.',
+                  file=sys.stderr)
+            sys.exit(1)
+        self.out_file = out_file
+        self.font_file = font_file
+        self.image = Image.open(image_file).convert('RGBA')
+        self.layer = Image.new('RGBA', self.image.size, (0, 0, 0, 0))
+        self.draw = ImageDraw.Draw(self.layer)
+        self.fonts = {}
+        self.font_files = {}
+
+    @staticmethod
+    def _color(props, prop, opacity_prop):
+        from PIL import ImageColor
+        color = props.get(prop)
+        if color is None or color == 'none':
+            return None
+        try:
+            rgb = ImageColor.getrgb(str(color))[:3]
+        except ValueError:
+            return None
+        alpha = css_number(props.get('opacity', 1), 1) * \
+            css_number(props.get(opacity_prop, 1), 1)
+        return rgb + (round(255 * min(max(alpha, 0), 1)),)
+
+    def _font(self, props):
+        from PIL import ImageFont
+        family = props.get('font-family')
+        size = float(props.get('font-size', 16))
+        if not((family, size) in self.fonts):
+            font_file = self.font_file or self._find_font(family)
+            if font_file:
+                font = ImageFont.truetype(font_file, size)
+            else:
+                font = ImageFont.load_default(size)
+            self.fonts[(family, size)] = font
+        return self.fonts[(family, size)]
+
+    def _find_font(self, family):
+        if not(family in self.font_files):
+            import subprocess
+            font_file = None
+            try:
+                res = subprocess.run(['fc-match', '-f', '%{file}',
+                                      family or 'sans-serif'],
+                                     capture_output=True, text=True)
+                font_file = res.stdout.strip() or None
+            except OSError:
+                pass
+            self.font_files[family] = font_file
+        return self.font_files[family]
+
+    def ellipse(self, x, y, rx, ry, rot, props):
+        # rotated ellipse as a polygon (same as transform="rotate(...)").
+        n = max(32, min(720, int(max(rx, ry))))
+        th = math.radians(rot)
+        cos_th = math.cos(th)
+        sin_th = math.sin(th)
+        points = []
+        for i in range(n):
+            t = 2 * math.pi * i / n
+            px = rx * math.cos(t)
+            py = ry * math.sin(t)
+            points.append((x + px * cos_th - py * sin_th,
+                           y + px * sin_th + py * cos_th))
+        fill = self._color(props, 'fill', 'fill-opacity')
+        if fill:
+            self.draw.polygon(points, fill=fill)
+        stroke = self._color(props, 'stroke', 'stroke-opacity')
+        width = round(css_number(props.get('stroke-width', 1), 1))
+        if stroke and width > 0:
+            self.draw.line(points + points[:1], fill=stroke, width=width,
+                           joint='curve')
+
+    def text(self, text, x, y, props):
+        fill = self._color(props, 'fill', 'fill-opacity')
+        if not fill:
+            return
+        anchor = { 'start': 'ls', 'middle': 'ms', 'end': 'rs' }.get(
+            props.get('text-anchor'), 'ls')
+        self.draw.text((x, y), text, fill=fill, font=self._font(props),
+                       anchor=anchor)
+
+    def begin_galaxy(self, name):
+        pass
+
+    def save(self):
+        from PIL import Image
+        image = Image.alpha_composite(self.image, self.layer)
+        format = raster_format(self.out_file)
+        if format == 'JPEG':
+            image.convert('RGB').save(self.out_file, format, quality=95)
+        else:
+            image.save(self.out_file, format)
+
+class FeatureWriter:
+    """Writes markers and labels as GeoJSON-like features.
+
+    Coordinates are in pixels of the full resolution image (y down).
+    Markers are polygons approximating the ellipses, with center, rx, ry
+    and rotation (degrees, clockwise as SVG) in properties, and labels are
+    points at the text baseline with the text, text-anchor and style
+    properties. Features of a galaxy share the "galaxy" property.
+    """
+    ELLIPSE_POINTS = 64
+
+    def __init__(self, out_file, image_w, image_h):
+        self.out_file = out_file
+        self.image_w = image_w
+        self.image_h = image_h
+        self.features = []
+        self.galaxy = -1
+        self.name = None
+
+    def begin_galaxy(self, name):
+        self.galaxy += 1
+        self.name = name
+
+    def _feature(self, kind, geometry, properties):
+        self.features.append({
+            'type': 'Feature',
+            'geometry': geometry,
+            'properties': { 'kind': kind, 'galaxy': self.galaxy,
+                            'name': self.name, **properties }
+        })
+
+    def ellipse(self, x, y, rx, ry, rot, props):
+        th = math.radians(rot)
+        ring = []
+        for i in range(self.ELLIPSE_POINTS + 1):
+            t = 2 * math.pi * (i % self.ELLIPSE_POINTS) / self.ELLIPSE_POINTS
+            px = rx * math.cos(t)
+            py = ry * math.sin(t)
+            ring.append([x + px * math.cos(th) - py * math.sin(th),
+                         y + px * math.sin(th) + py * math.cos(th)])
+        self._feature('marker', { 'type': 'Polygon', 'coordinates': [ring] },
+                      { 'center': [x, y], 'rx': rx, 'ry': ry, 'rotation': rot,
+                        'style': { k: v for k, v in props.items()
+                                   if not(k in non_svg_marker_style_defaults) }
+                        })
+
+    def text(self, text, x, y, props):
+        self._feature('label', { 'type': 'Point', 'coordinates': [x, y] },
+                      { 'text': text,
+                        'style': { k: v for k, v in props.items()
+                                   if not(k in non_svg_desc_style_defaults) }
+                        })
+
+    def save(self):
+        with open(self.out_file, 'w', encoding='utf-8') as f:
+            json.dump({ 'type': 'FeatureCollection',
+                        'size': [self.image_w, self.image_h],
+                        'features': self.features }, f, ensure_ascii=False)
+
+def write_deep_zoom(image_file, out_dir, tile_size=256, overlap=1):
+    """Writes tile pyramid of image_file in Deep Zoom format to out_dir.
+
+    out_dir/image.dzi describes the image, and tiles of level L (0 is 1x1
+    pixel, the last level is the full resolution) are written to
+    out_dir/image_files/L/COLUMN_ROW.jpg. Each level is halved from the
+    next level, so only one level is kept in memory besides the tiles.
+    """
+    from PIL import Image
+    Image.MAX_IMAGE_PIXELS = None
+    image = Image.open(image_file)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    width, height = image.size
+    max_level = math.ceil(math.log2(max(width, height, 1)))
+    with open(os.path.join(out_dir, 'image.dzi'), 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                'TileSize="{}" Overlap="{}" Format="jpg">'
+                '<Size Width="{}" Height="{}"/></Image>\n'.format(
+                    tile_size, overlap, width, height))
+    for level in range(max_level, -1, -1):
+        scale = 2 ** (max_level - level)
+        level_size = (math.ceil(width / scale), math.ceil(height / scale))
+        if image.size != level_size:
+            # halving by reduce() makes the sizes of DZI levels (ceil) and
+            # needs no intermediate image.
+            image = image.reduce(2)
+        level_dir = os.path.join(out_dir, 'image_files', str(level))
+        os.makedirs(level_dir, exist_ok=True)
+        for col in range(math.ceil(level_size[0] / tile_size)):
+            for row in range(math.ceil(level_size[1] / tile_size)):
+                x0 = max(col * tile_size - overlap, 0)
+                y0 = max(row * tile_size - overlap, 0)
+                x1 = min((col + 1) * tile_size + overlap, level_size[0])
+                y1 = min((row + 1) * tile_size + overlap, level_size[1])
+                image.crop((x0, y0, x1, y1)).save(
+                    os.path.join(level_dir, '{}_{}.jpg'.format(col, row)),
+                    'JPEG', quality=90)
+
+class GalaxyIndex:
+    """Zone index of galaxy positions for cone search.
+
+    Galaxies are sorted by declination zones of ZONE_HEIGHT degrees and
+    by RA in each zone, so galaxies near a point of the sky are found by
+    binary search without projecting the whole catalog.
+    """
+    ZONE_HEIGHT = 0.5
+
+    def __init__(self, ra, dec, order=None, zone_start=None, source=''):
+        import numpy as np
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        n_zones = int(math.ceil(180 / self.ZONE_HEIGHT))
+        if order is None:
+            ra = np.mod(ra, 360.0)
+            zone = np.minimum(((dec + 90) // self.ZONE_HEIGHT).astype(int),
+                              n_zones - 1)
+            order = np.lexsort((ra, zone))
+            ra = ra[order]
+            dec = dec[order]
+            zone_start = np.searchsorted(zone[order], np.arange(n_zones + 1))
+        self.ra = ra
+        self.dec = dec
+        self.order = order
+        self.zone_start = zone_start
+        self.source = source
+        ra_r = np.radians(ra)
+        dec_r = np.radians(dec)
+        self.xyz = np.column_stack([np.cos(dec_r) * np.cos(ra_r),
+                                    np.cos(dec_r) * np.sin(ra_r),
+                                    np.sin(dec_r)])
+
+    @classmethod
+    def from_galaxies(cls, galaxies, source=''):
+        return cls(galaxies.column('al2000') * 15, galaxies.column('de2000'),
+                   source=source)
+
+    @classmethod
+    def load(cls, file):
+        import numpy as np
+        with np.load(file) as data:
+            return cls(data['ra'], data['dec'], data['order'],
+                       data['zone_start'], str(data['source']))
+
+    def save(self, file):
+        import numpy as np
+        with open(file, 'wb') as f:
+            np.savez(f, ra=self.ra, dec=self.dec, order=self.order,
+                     zone_start=self.zone_start, source=self.source)
+
+    def _zone(self, dec):
+        n_zones = len(self.zone_start) - 1
+        return min(max(int((dec + 90) // self.ZONE_HEIGHT), 0), n_zones - 1)
+
+    def query(self, ra, dec, radius):
+        """Return catalog indices (sorted) of galaxies within radius degrees
+        of (ra, dec) in degrees."""
+        import numpy as np
+        ra = ra % 360.0
+        if abs(dec) + radius >= 90:
+            alpha = 180
+        else:
+            alpha = math.degrees(math.asin(math.sin(math.radians(radius)) /
+                                           math.cos(math.radians(dec))))
+        if alpha >= 180:
+            ra_ranges = [(0, 360)]
+        elif ra - alpha < 0:
+            ra_ranges = [(ra - alpha + 360, 360), (0, ra + alpha)]
+        elif ra + alpha >= 360:
+            ra_ranges = [(ra - alpha, 360), (0, ra + alpha - 360)]
+        else:
+            ra_ranges = [(ra - alpha, ra + alpha)]
+
+        candidates = []
+        zones = range(self._zone(dec - radius), self._zone(dec + radius) + 1)
+        for zone in zones:
+            start = self.zone_start[zone]
+            end = self.zone_start[zone + 1]
+            zone_ra = self.ra[start:end]
+            for ra_min, ra_max in ra_ranges:
+                i0 = np.searchsorted(zone_ra, ra_min, side='left')
+                i1 = np.searchsorted(zone_ra, ra_max, side='right')
+                candidates.append(np.arange(start + i0, start + i1))
+        if not candidates:
+            return np.array([], dtype=int)
+        candidates = np.unique(np.concatenate(candidates))
+        ra_r = math.radians(ra)
+        dec_r = math.radians(dec)
+        center = np.array([math.cos(dec_r) * math.cos(ra_r),
+                           math.cos(dec_r) * math.sin(ra_r),
+                           math.sin(dec_r)])
+        inside = self.xyz[candidates] @ center >= math.cos(math.radians(radius))
+        return np.sort(self.order[candidates[inside]])
+
+def local_marker_axes(w, x, y, pa, r, rot_hint):
+    """Geometry of markers of ellipses on the sky with position angle pa
+    (degrees) and axis ratio r at pixel coordinates (x, y) by the Jacobian
+    of w at each point. Returns the length in pixels of 1 degree of the
+    major axis, the axis ratio and the rotation (degrees, as rot_hint modulo
+    180) of the ellipses in the image."""
+    import numpy as np
+    j11, j12, j21, j22 = w.jacobian(x, y)
+    det = j11 * j22 - j12 * j21
+    # pixels per degree of offsets to the east and to the north.
+    l11, l12, l21, l22 = j22 / det, -j12 / det, -j21 / det, j11 / det
+    sin_pa = np.sin(np.radians(pa))
+    cos_pa = np.cos(np.radians(pa))
+    # images of the major axis (to pa) and the minor axis (1 / r of it).
+    a = l11 * sin_pa + l12 * cos_pa
+    c = l21 * sin_pa + l22 * cos_pa
+    b = (l11 * cos_pa - l12 * sin_pa) / r
+    d = (l21 * cos_pa - l22 * sin_pa) / r
+    # singular values of [[a, b], [c, d]] and the direction of the major
+    # axis (left singular vector of the larger one).
+    e, f, g, h = (a + d) / 2, (a - d) / 2, (c + b) / 2, (c - b) / 2
+    q = np.hypot(e, h)
+    t = np.hypot(f, g)
+    theta = np.degrees(np.arctan2(g, f) + np.arctan2(h, e)) / 2
+    # the major axis of an unrotated marker is vertical.
+    rot = theta - 90
+    rot = rot_hint + (rot - rot_hint + 90) % 180 - 90
+    return q + t, (q + t) / np.abs(q - t), rot
+
+def catalog_source(galaxies_json):
+    st = os.stat(galaxies_json)
+    return '{}:{}:{}'.format(os.path.abspath(galaxies_json), st.st_size,
+                             st.st_mtime_ns)
+
+def load_index(galaxies, galaxies_json, index_file=None):
+    source = catalog_source(galaxies_json)
+    if index_file and os.path.exists(index_file):
+        index = GalaxyIndex.load(index_file)
+        if index.source == source:
+            return index
+    index = GalaxyIndex.from_galaxies(galaxies, source)
+    if index_file:
+        index.save(index_file)
+        print("index: saved '{}'.".format(index_file), file=sys.stderr)
+    return index
+
+def memory_usage():
+    """Current and peak resident set size of the process in bytes (None if
+    not available on the platform)."""
+    rss = None
+    peak_rss = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in KB except on macOS.
+        if sys.platform != 'darwin':
+            peak_rss *= 1024
+    except ImportError:
+        pass
+    return rss, peak_rss
+
+class StageTimer:
+    """Elapsed time and memory usage of each stage of the script.
+
+    Time is split into time spent in importing modules (measured by
+    hooking __import__) and the rest. Memory usage is the resident set size
+    at the end of the stage and its peak so far. Counters (e.g. number of
+    galaxies) are set by count(). Imports are timed until close() (or the
+    end of the with statement), which restores __import__.
+    """
+    def __init__(self, start=None, imported=None):
+        import builtins
+        self.last = time.perf_counter()
+        self.last_import = 0
+        self.import_time = 0
+        self.stages = []
+        self.counters = {}
+        if start is not None:
+            # imports of the script and parsing of arguments.
+            self.stages.append(('script imports', imported - start,
+                                imported - start, None, None))
+            self.stages.append(('parse arguments', self.last - imported, 0,
+                                *memory_usage()))
+        self.depth = 0
+        self.builtin_import = builtins.__import__
+        self.import_hook = self._import
+        builtins.__import__ = self.import_hook
+
+    def close(self):
+        """Stop timing imports."""
+        import builtins
+        if builtins.__import__ is self.import_hook:
+            builtins.__import__ = self.builtin_import
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _import(self, *args, **kwargs):
+        if self.depth:
+            return self.builtin_import(*args, **kwargs)
+        self.depth += 1
+        t = time.perf_counter()
+        try:
+            return self.builtin_import(*args, **kwargs)
+        finally:
+            self.import_time += time.perf_counter() - t
+            self.depth -= 1
+
+    def stage(self, name):
+        """End the current stage as name."""
+        now = time.perf_counter()
+        self.stages.append((name, now - self.last,
+                            self.import_time - self.last_import,
+                            *memory_usage()))
+        self.last = now
+        self.last_import = self.import_time
+
+    def count(self, name, value):
+        self.counters[name] = value
+
+    def report(self, file=sys.stderr):
+        print('{:>10} {:>10} {:>10}  stage'.format('total', 'import',
+                                                   'compute'), file=file)
+        for name, t, t_import, rss, peak_rss in self.stages + [
+                ('total', sum(s[1] for s in self.stages),
+                 sum(s[2] for s in self.stages), None, None) ]:
+            print('{:>7.1f} ms {:>7.1f} ms {:>7.1f} ms  {}'.format(
+                t * 1000, t_import * 1000, (t - t_import) * 1000, name),
+                  file=file)
+
+    def to_dict(self):
+        stages = [ { 'name': name, 'time': t, 'import_time': t_import,
+                     'rss': rss, 'peak_rss': peak_rss }
+                   for name, t, t_import, rss, peak_rss in self.stages ]
+        return {
+            'stages': stages,
+            'total': {
+                'time': sum(s['time'] for s in stages),
+                'import_time': sum(s['import_time'] for s in stages),
+                'peak_rss': memory_usage()[1]
+            },
+            'counters': self.counters
+        }
+
+    def write_json(self, file):
+        """Write stats as JSON to file ('-' for standard output)."""
+        if file == '-':
+            json.dump(self.to_dict(), sys.stdout, indent=2)
+            print()
+        else:
+            with open(file, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f, indent=2)
+                f.write('\n')
+
+def annotate(galaxies, galaxies_json, style, style_sheet,
+             wcs, image_file, out_file, opts, index=None, timer=None,
+             styles=None):
+    """Annotate image_file solved by wcs (path of wcs.fits or its header)
+    with galaxies and write to out_file (file name of SVG/PNG/JPEG, text
+    file object for SVG, or None for no SVG output). Returns the tilt
+    (degrees) and pixel scale (degrees per pixel) of the image as a dict
+    with keys 'tilt' and 'scale'."""
+    import svgwrite
+    import numpy as np
+    from fast_wcs import load_wcs, angular_separation
+    if timer:
+        timer.stage('imports')
+
+    debug = opts.debug
+    # per-galaxy log (costs much stdout I/O for many galaxies).
+    verbose = opts.verbose or debug
+    if styles is None:
+        styles = StyleCache(style, galaxies_json)
+
+    w, header = load_wcs(wcs, use_astropy=opts.astropy_wcs)
+    image_w = header['IMAGEW']
+    image_h = header['IMAGEH']
+
+    left_ra, left_dec = w.pixel_to_world(0, 0)
+    right_ra, right_dec = w.pixel_to_world(image_w, 0)
+    x2, y2 = w.world_to_pixel(right_ra, left_dec)
+    image_tilt = math.degrees(math.atan(y2 / x2))
+    scales = w.pixel_scales()
+    px_scale = (scales[0] + scales[1]) / 2
+    if timer:
+        timer.stage('wcs load ({})'.format(type(w).__name__))
+
+    # out_file is a file name or a text file object to write SVG to.
+    out_name = out_file if isinstance(out_file, str) else None
+    # sidecar cache of SVG output (not used with other outputs and the
+    # per-galaxy log, which need every galaxy drawn).
+    cache = None
+    if opts.incremental and out_name and not raster_format(out_name) and \
+       not (opts.raster or opts.deep_zoom or verbose):
+        cache = AnnotationCache(out_name)
+        wcs_key = content_hash([ [k, v] for k, v in header.items() ])
+    drw = svgwrite.Drawing(out_name or 'noname.svg', size=(image_w, image_h))
+    drw.add(drw.style(style_sheet))
+    # writers of markers and labels other than SVG.
+    overlays = []
+    if not out_file:
+        svg_out = NullWriter()
+    elif out_name and raster_format(out_name):
+        svg_out = NullWriter()
+        overlays.append(RasterWriter(image_file, out_name, opts.font))
+    else:
+        # cached fragments are written as text in stream mode, whose output
+        # is the same.
+        svg_out = SVGWriter(drw, stream=opts.stream or cache is not None,
+                            pretty=opts.pretty,
+                            out=None if out_name else out_file)
+        if opts.raster:
+            overlays.append(RasterWriter(image_file, opts.raster, opts.font))
+    if opts.deep_zoom:
+        os.makedirs(opts.deep_zoom, exist_ok=True)
+        write_deep_zoom(image_file, opts.deep_zoom, opts.tile_size)
+        overlays.append(FeatureWriter(os.path.join(opts.deep_zoom,
+                                                   'annotations.json'),
+                                      image_w, image_h))
+
+    if isinstance(svg_out, SVGWriter):
+        if opts.link_image:
+            out_dir = os.path.dirname(os.path.abspath(out_name or
+                                                      'noname.svg'))
+            image_href = os.path.relpath(os.path.abspath(image_file), out_dir)
+            drw.add(drw.image(image_href.replace(os.sep, '/')))
+        else:
+            image_data = cache.image_data(image_file) if cache else ()
+            svg_out.embed_image(image_file, get_image_mime(image_file),
+                                *image_data)
+    if timer:
+        timer.stage('image embed')
+
+    projection = None
+    if cache:
+        projection_key = content_hash(
+            wcs_key, opts.astropy_wcs, index is not None,
+            np.ascontiguousarray(galaxies.column('al2000')).tobytes(),
+            np.ascontiguousarray(galaxies.column('de2000')).tobytes())
+        projection = cache.projection(projection_key)
+    if projection is None:
+        candidates = np.arange(len(galaxies))
+        if index:
+            # search galaxies in the cone which includes the whole image.
+            center_ra, center_dec = w.pixel_to_world(image_w / 2, image_h / 2)
+            edge_x = [0, image_w / 2, image_w, image_w, image_w, image_w / 2,
+                      0, 0]
+            edge_y = [0, 0, 0, image_h / 2, image_h, image_h, image_h,
+                      image_h / 2]
+            edge_ra, edge_dec = w.pixel_to_world(edge_x, edge_y)
+            radius = max(angular_separation(center_ra, center_dec,
+                                            edge_ra, edge_dec)) * 1.01
+            center_ra, center_dec = w.to_icrs(center_ra, center_dec)
+            candidates = index.query(float(center_ra), float(center_dec),
+                                     radius)
+        gal_ra = galaxies.column('al2000')[candidates]
+        gal_dec = galaxies.column('de2000')[candidates]
+        gal_x, gal_y = w.world_to_pixel(gal_ra * 15, gal_dec)
+        gal_x = np.atleast_1d(gal_x)
+        gal_y = np.atleast_1d(gal_y)
+        in_image = (gal_x >= 0) & (gal_y >= 0) & \
+                   (gal_x <= image_w) & (gal_y <= image_h)
+        projection = (len(candidates), candidates[in_image], gal_x[in_image],
+                      gal_y[in_image])
+        if cache:
+            cache.put_projection(*projection)
+    n_candidates, visible, gal_x, gal_y = projection
+    n_in_image = len(visible)
+    n_selected = len(visible)
+    if opts.lod:
+        # keep opts.lod most significant galaxies in each cell (and put the
+        # others after them for the faint layer).
+        cell_x = np.floor(gal_x / opts.lod_cell)
+        cell_y = np.floor(gal_y / opts.lod_cell)
+        logd25 = galaxies.column('logd25')[visible]
+        size_rank = np.where(np.isnan(logd25), np.inf, -logd25)
+        if opts.lod_rank == 'mag':
+            mag = galaxies.column('mag')[visible]
+            keys = (size_rank, np.where(np.isnan(mag), np.inf, mag))
+        else:
+            keys = (size_rank,)
+        order = np.lexsort(keys + (cell_x, cell_y))
+        cell_id = np.stack([cell_y[order], cell_x[order]], axis=1)
+        new_cell = np.ones(len(order), dtype=bool)
+        new_cell[1:] = np.any(cell_id[1:] != cell_id[:-1], axis=1)
+        cell_start = np.maximum.accumulate(np.where(new_cell,
+                                                    np.arange(len(order)), 0))
+        selected = np.zeros(len(visible), dtype=bool)
+        selected[order[np.arange(len(order)) - cell_start < opts.lod]] = True
+        n_selected = int(np.count_nonzero(selected))
+        if opts.lod_layers:
+            lod_order = np.concatenate([np.flatnonzero(selected),
+                                        np.flatnonzero(~selected)])
+        else:
+            lod_order = np.flatnonzero(selected)
+        visible = visible[lod_order]
+        gal_x = gal_x[lod_order]
+        gal_y = gal_y[lod_order]
+        print('lod: {} of {} galaxies selected.'.format(n_selected,
+                                                        len(selected)),
+              file=sys.stderr)
+    visible_gals = [galaxies[i] for i in visible]
+    if timer:
+        timer.stage('projection')
+        timer.count('galaxies', len(galaxies))
+        timer.count('candidates', n_candidates)
+        timer.count('in_image', n_in_image)
+        timer.count('drawn', len(visible))
+
+    gal_styles = [styles.get(gal) for gal in visible_gals]
+    if timer:
+        timer.stage('style resolution')
+    marker_size = np.array([gs.size for gs in gal_styles], dtype=float)
+    marker_min_r = np.array([gs.min_r for gs in gal_styles], dtype=float)
+    marker_min_size_r = np.array([gs.min_size_r for gs in gal_styles],
+                                 dtype=float)
+    marker_min_size = np.array([gs.min_size for gs in gal_styles],
+                               dtype=float)
+
+    # null (NaN) and 0 are treated as no data.
+    gal_pa = np.nan_to_num(galaxies.column('pa')[visible])
+    gal_logd25 = galaxies.column('logd25')[visible]
+    gal_logr25 = np.nan_to_num(galaxies.column('logr25')[visible])
+    has_d = ~np.isnan(gal_logd25) & (gal_logd25 != 0)
+    gal_d = 10 ** gal_logd25 / 10 / 60
+    gal_r = 10 ** gal_logr25
+
+    if opts.global_marker_geometry:
+        marker_rot = -1.0 * (gal_pa - image_tilt)
+        gal_ry = gal_d / 2 / px_scale
+    else:
+        # scale, rotation and distortion of the image at each galaxy.
+        px_per_deg, gal_r, marker_rot = local_marker_axes(
+            w, gal_x, gal_y, gal_pa, gal_r, image_tilt - gal_pa)
+        gal_ry = gal_d / 2 * px_per_deg
+    sz = (gal_ry - marker_min_r) * (marker_min_size - marker_size) / \
+         (marker_min_size_r - marker_min_r) + marker_size
+    marker_ry = gal_ry * np.maximum(sz, marker_min_size)
+    # min-r of the style is written as is (e.g. ry="15", not "15.0").
+    at_min_r = ~has_d | (marker_ry < marker_min_r)
+    marker_ry = np.where(at_min_r, marker_min_r, marker_ry)
+    marker_rx = marker_ry / gal_r
+
+    th = np.radians(marker_rot)
+    marker_dx = np.sqrt(marker_rx**2 * np.cos(th)**2 +
+                        marker_ry**2 * np.sin(th)**2)
+    marker_dy = np.sqrt(marker_rx**2 * np.sin(th)**2 +
+                        marker_ry**2 * np.cos(th)**2)
+
+    if timer:
+        timer.stage('marker geometry')
+
+    if cache:
+        render_key = content_hash(wcs_key, style, style_sheet, opts.pretty,
+                                  opts.astropy_wcs,
+                                  opts.global_marker_geometry)
+    if opts.auto_label_position:
+        labels = None
+        if cache:
+            labels_key = content_hash(render_key, visible_gals,
+                                      gal_x.tobytes(), gal_y.tobytes())
+            labels = cache.labels(labels_key)
+        if labels is None:
+            gal_styles = place_labels(visible_gals, gal_styles, styles,
+                                      gal_x, gal_y, marker_dx, marker_dy,
+                                      image_w, image_h)
+            if cache:
+                cache.put_labels([ gs.y_pos + '-' + gs.x_pos
+                                   for gs in gal_styles ])
+        else:
+            # same styles as place_labels() chose.
+            gal_styles = [ gs if pos == gs.y_pos + '-' + gs.x_pos
+                           else styles.get_at(gal, pos)
+                           for gal, gs, pos in zip(visible_gals, gal_styles,
+                                                   labels) ]
+        if timer:
+            timer.stage('label placement')
+
+    layers = opts.lod and opts.lod_layers
+    if layers:
+        svg_out.begin_group(drw.g(id='galaxies'))
+    for gi, gal in enumerate(visible_gals):
+        x, y = float(gal_x[gi]), float(gal_y[gi])
+        if layers and gi == n_selected:
+            svg_out.end_group()
+            svg_out.begin_group(drw.g(id='faint-galaxies'))
+
+        gs = gal_styles[gi]
+        if cache:
+            fragment_key = content_hash(
+                render_key, gal, x, y, svg_out.depth,
+                [ gs.x_pos, gs.y_pos, gs.label_valign, gs.marker_ss,
+                  gs.name_ss, gs.desc_ss ])
+            fragment = cache.fragment(fragment_key)
+            if fragment is not None:
+                svg_out.add_fragment(fragment)
+                continue
+            svg_out.begin_fragment()
+        x_pos = gs.x_pos
+        y_pos = gs.y_pos
+
+        svg_group = drw.g()
+        gal_name = gal['name']
+        for overlay in overlays:
+            overlay.begin_galaxy(gal_name)
+        if verbose:
+            print("{name}: ({x}, {y})".format(name=gal_name, x=x, y=y))
+        rx = float(marker_rx[gi])
+        ry = gs.min_r if at_min_r[gi] else float(marker_ry[gi])
+        rot = float(marker_rot[gi])
+        dx = float(marker_dx[gi])
+        dy = float(marker_dy[gi])
+        if verbose:
+            print("  d={d}".format(d=float(gal_d[gi]) if has_d[gi] else None))
+            print("  marker: ({rx} x {ry}), rot={rot}".format(rx=rx, ry=ry,
+                                                              rot=rot))
+        transform = "rotate({rot}, {x}, {y})".format(rot=rot, x=x, y=y)
+        ellipse = drw.ellipse(center=(x, y), r=(rx, ry),
+                              transform=transform, class_='marker')
+        if gs.marker_ss:
+            ellipse.update({ 'style': gs.marker_ss })
+        svg_group.add(ellipse)
+        for overlay in overlays:
+            overlay.ellipse(x, y, rx, ry, rot, gs.marker_props)
+    
+        x_margin = gs.x_margin
+        y_margin = gs.y_margin
+
+        desc_height = gs.desc_height
+        name_height = gs.name_height
+        name_x, name_y = gs.label_origin(x, y, dx, dy)
+    
+        if verbose:
+            print("  name: ({x}, {y})".format(x=name_x, y=name_y))
+        name_text = drw.text(gal_name, x=[name_x], y=[name_y], class_='name')
+        if gs.name_ss:
+            name_text.update({ 'style': gs.name_ss })
+        svg_group.add(name_text)
+        for overlay in overlays:
+            overlay.text(gal_name, name_x, name_y, gs.name_props)
+    
+        if len(gal['descs']) > 0:
+            desc_x = name_x
+            desc_y = name_y
+            for i, desc in enumerate(gal['descs']):
+                desc_y += gs.desc_line_heights[i]
+                if verbose:
+                    print("  desc[{i}]: ({x}, {y})".format(i=i, x=desc_x,
+                                                           y=desc_y))
+                desc_text = drw.text(desc, x=[desc_x], y=[desc_y],
+                                     class_='desc'+str(i))
+                if gs.desc_ss and i < len(gs.desc_ss):
+                    desc_text.update({ 'style': gs.desc_ss[i] })
+                svg_group.add(desc_text)
+                for overlay in overlays:
+                    overlay.text(desc, desc_x, desc_y, gs.desc_props[i])
+
+        svg_out.add(svg_group)
+
+        if debug:
+            marker_rect = drw.rect(insert=(x-dx,y-dy), size=(2*dx,2*dy),
+                                   class_='debug_marker')
+            margin_rect = drw.rect(insert=(x-dx-x_margin,y-dy-y_margin),
+                                   size=(2*(dx+x_margin),2*(dy+y_margin)),
+                                   class_='debug_margin')
+            center_line_h = drw.line(start=(x-dx-x_margin,y),
+                                     end=(x+dx+x_margin,y),
+                                     class_='debug_centerline')
+            center_line_v = drw.line(start=(x,y-dy-y_margin),
+                                     end=(x,y+dy+y_margin),
+                                     class_='debug_centerline')
+            label_width = name_height*12 # not a real width.
+            name_baseline = drw.line(start=(name_x,name_y),
+                                     end=(name_x+label_width,name_y),
+                                     class_='debug_baseline')
+            middle_y = name_y - name_height + (name_height + desc_height) / 2
+            label_middleline = drw.line(start=(name_x,middle_y),
+                                        end=(name_x+label_width,middle_y),
+                                        class_='debug_middleline')
+            label_rect = drw.rect(insert=(name_x,name_y-name_height),
+                                  size=(label_width,name_height+desc_height),
+                                  class_='debug_label')
+            if x_pos == 'left':
+                name_baseline.scale(-1, 1)
+                name_baseline.translate(-name_x*2, 0)
+                label_middleline.scale(-1, 1)
+                label_middleline.translate(-name_x*2, 0)
+                label_rect.scale(-1, 1)
+                label_rect.translate(-name_x*2, 0)
+            elif x_pos == 'middle':
+                center_x = name_x + label_width / 2
+                label_centerline = drw.line(start=(center_x,name_y-name_height),
+                                            end=(center_x,name_y+desc_height),
+                                            class_='debug_middleline')
+                name_baseline.translate(-label_width/2, 0)
+                label_middleline.translate(-label_width/2, 0)
+                label_centerline.translate(-label_width/2, 0)
+                label_rect.translate(-label_width/2, 0)
+            
+            debug_group = drw.g()
+            debug_group.add(marker_rect)
+            debug_group.add(margin_rect)
+            debug_group.add(center_line_h)
+            debug_group.add(center_line_v)
+            debug_group.add(name_baseline)
+            debug_group.add(label_middleline)
+            if x_pos == 'middle':
+                debug_group.add(label_centerline)
+            debug_group.add(label_rect)
+            svg_out.add(debug_group)
+        if cache:
+            cache.put_fragment(fragment_key, svg_out.end_fragment())
+
+    if layers:
+        svg_out.end_group()
+    if timer:
+        timer.stage('svg build')
+    svg_out.close()
+    for overlay in overlays:
+        overlay.save()
+    if cache:
+        cache.save()
+    if timer:
+        timer.stage('save')
+        if cache:
+            timer.count('cached', cache.hits)
+    return { 'tilt': image_tilt, 'scale': px_scale }
+
+
+# options of annotate() (same as the command line options of
+# 'galaxy-annotator.py').
+DEFAULT_OPTIONS = {
+    'link_image': False,
+    'raster': None,
+    'font': None,
+    'deep_zoom': None,
+    'tile_size': 256,
+    'stream': False,
+    'pretty': True,
+    'auto_label_position': False,
+    'lod': None,
+    'lod_cell': 256,
+    'lod_rank': 'mag',
+    'lod_layers': False,
+    'astropy_wcs': False,
+    'global_marker_geometry': False,
+    'incremental': False,
+    'verbose': False,
+    'debug': False
+}
+
+class Annotator:
+    """Annotates images with galaxies of a catalog.
+
+    The catalog, style and galaxy index (if index_file or use_index) are
+    loaded once and shared by annotate() and write() of many images.
+    Options are keyword arguments or attributes of opts (e.g. parsed
+    command line arguments) of DEFAULT_OPTIONS.
+    """
+    def __init__(self, galaxies_json, style_json, index_file=None,
+                 use_index=False, opts=None, timer=None, **options):
+        self.opts = SimpleNamespace(**DEFAULT_OPTIONS)
+        if opts is not None:
+            self.opts.__dict__.update(vars(opts))
+        self.opts.__dict__.update(options)
+        self.galaxies_json = galaxies_json
+        self.galaxies = load_catalog(galaxies_json)
+        if timer:
+            timer.stage('catalog parse')
+        self.style, self.style_sheet = load_style(style_json, self.opts.debug)
+        self.styles = StyleCache(self.style, galaxies_json)
+        if timer:
+            timer.stage('style load')
+        self.index = None
+        if index_file or use_index:
+            self.index = load_index(self.galaxies, galaxies_json, index_file)
+            if timer:
+                timer.stage('index load')
+
+    def write(self, wcs, image_file, out_file, timer=None):
+        """Annotate image_file solved by wcs (path of wcs.fits or its
+        header) and write to out_file (SVG, or PNG/JPEG by extension).
+        Returns the tilt and pixel scale of the image (see annotate())."""
+        return annotate(self.galaxies, self.galaxies_json, self.style,
+                 self.style_sheet, wcs, image_file, out_file, self.opts,
+                 self.index, timer, self.styles)
+
+    def annotate(self, wcs, image_file):
+        """Annotate image_file solved by wcs (path of wcs.fits or its
+        header) and return SVG as bytes."""
+        out = io.StringIO()
+        self.write(wcs, image_file, out)
+        return out.getvalue().encode('utf-8')
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+import sys
+import os
+import os.path
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+argparser = ArgumentParser(description='Measure peak memory usage of '\
+                           "'galaxy-annotator.py' embedding a synthetic "\
+                           'large image.')
+argparser.add_argument("-s", "--sizes", default="16,64,128",
+                       help="image sizes in MB separated by comma "\
+                       "(default: 16,64,128).")
+argparser.add_argument("--script",
+                       default=os.path.join(BASE_DIR, 'galaxy-annotator.py'),
+                       help="annotator script to measure (e.g. an older "\
+                       "version extracted by 'git show').")
+argparser.add_argument("--option", dest="options", action="append",
+                       default=[], metavar='OPT',
+                       help="option passed to the annotator (repeatable).")
+args = argparser.parse_args()
+
+def make_image(path, size):
+    # JPEG SOI marker followed by incompressible data.
+    with open(path, 'wb') as f:
+        f.write(b'\xff\xd8\xff\xe0')
+        remain = size - 4
+        while remain > 0:
+            n = min(remain, 1024 * 1024)
+            f.write(os.urandom(n))
+            remain -= n
+
+def run(cmd):
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        print('ERROR: {} exited with {}'.format(cmd, proc.returncode),
+              file=sys.stderr)
+        sys.exit(1)
+    # ru_maxrss is in KB on Linux.
+    return rusage.ru_maxrss / 1024
+
+with tempfile.TemporaryDirectory() as tmp:
+    print('image_mb,peak_rss_mb')
+    for size_mb in map(int, args.sizes.split(',')):
+        image = os.path.join(tmp, 'image.jpg')
+        make_image(image, size_mb * 1024 * 1024)
+        rss = run([sys.executable, args.script, '-f'] + args.options +
+                  [os.path.join(BASE_DIR, 'sample-galaxies.json'),
+                   os.path.join(BASE_DIR, 'sample-style.json'),
+                   os.path.join(BASE_DIR, 'test-data', 'test-wcs.fits'),
+                   image, os.path.join(tmp, 'out.svg')])
+        print('{},{:.1f}'.format(size_mb, rss))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+import sys
+import re
+import os
+import os.path
+import json
+import time
+import threading
+import subprocess
+import tempfile
+import http.server
+import urllib.parse
+from argparse import ArgumentParser
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+from fast_wcs import load_wcs
+import hyperleda
+
+TOOLS = [ 'annotator', 'converter', 'get-votable' ]
+VOTABLE_FIELDS = [ 'pgc', 'objname', 'objtype', 'al2000', 'de2000', 'pa',
+                   'logd25', 'logr25', 'bt', 'vt', 'it', 'v', 'mod0',
+                   'hl_names' ]
+
+argparser = ArgumentParser(description='Measure throughput and peak memory '\
+                           "usage of 'galaxy-annotator.py', "\
+                           "'leda-votable-to-galaxy.py' and "\
+                           "'leda-get-votable.py' with synthetic catalogs "\
+                           "around 'test-data/test-wcs.fits'.")
+argparser.add_argument("-s", "--sizes", default="1000,10000,100000,1000000",
+                       help="numbers of galaxies of synthetic catalogs "\
+                       "separated by comma (default: "\
+                       "1000,10000,100000,1000000).")
+argparser.add_argument("-t", "--tools", default=','.join(TOOLS),
+                       help="tools to measure separated by comma (default: "\
+                       "{}).".format(','.join(TOOLS)))
+argparser.add_argument("--spread", type=float, default=5, metavar="DEG",
+                       help="radius in degrees of the area around the field "\
+                       "of view where galaxies are placed (default: 5).")
+argparser.add_argument("--image-mb", dest="image_mb", type=float, default=0,
+                       metavar="MB",
+                       help="size of synthetic image in MB for the annotator "\
+                       "(default: 0, use 'test-data/test-in.jpg').")
+argparser.add_argument("--option", dest="options", action="append",
+                       default=[], metavar='OPT',
+                       help="option passed to the annotator (repeatable).")
+argparser.add_argument("--stats-dir", dest="stats_dir", metavar="DIR",
+                       help="save '--stats' output of the annotator for "\
+                       "each size to DIR.")
+argparser.add_argument("--seed", type=int, default=1,
+                       help="seed of random numbers (default: 1).")
+args = argparser.parse_args()
+
+WCS_FITS = os.path.join(BASE_DIR, 'test-data', 'test-wcs.fits')
+
+def field_center():
+    w, header = load_wcs(WCS_FITS)
+    ra, dec = w.pixel_to_world(header['IMAGEW'] / 2, header['IMAGEH'] / 2)
+    ra, dec = w.to_icrs(ra, dec)
+    return float(ra), float(dec)
+
+def random_positions(n, ra0, dec0, radius, rng):
+    # uniform in the spherical cap of radius around (ra0, dec0).
+    cos_r = np.cos(np.radians(radius))
+    z = rng.uniform(cos_r, 1, n)
+    phi = rng.uniform(0, 2 * np.pi, n)
+    s = np.sqrt(1 - z ** 2)
+    v = np.stack([z, s * np.cos(phi), s * np.sin(phi)])
+    # rotate the pole (1, 0, 0) to (ra0, dec0).
+    a = np.radians(ra0)
+    d = np.radians(dec0)
+    rot = np.array([[np.cos(a) * np.cos(d), -np.sin(a),
+                     -np.cos(a) * np.sin(d)],
+                    [np.sin(a) * np.cos(d), np.cos(a),
+                     -np.sin(a) * np.sin(d)],
+                    [np.sin(d), 0, np.cos(d)]])
+    x, y, z = rot @ v
+    ra = np.degrees(np.arctan2(y, x)) % 360
+    dec = np.degrees(np.arcsin(np.clip(z, -1, 1)))
+    return ra, dec
+
+class SyntheticCatalog:
+    def __init__(self, n, rng):
+        ra0, dec0 = field_center()
+        ra, dec = random_positions(n, ra0, dec0, args.spread, rng)
+        self.n = n
+        self.pgc = np.arange(1, n + 1) + 1000000
+        self.ra = ra / 15
+        self.dec = dec
+        self.pa = rng.uniform(0, 180, n)
+        self.logd25 = rng.uniform(0.1, 1.5, n)
+        self.logr25 = rng.uniform(0, 0.8, n)
+        self.mag = rng.uniform(10, 20, n)
+        self.v = rng.uniform(300, 30000, n)
+        # some galaxies have catalogue names other than PGC.
+        self.kind = rng.choice(4, n, p=[0.001, 0.02, 0.03, 0.949])
+
+    def names(self, i):
+        names = [ 'PGC{:07d}'.format(self.pgc[i]) ]
+        kind = self.kind[i]
+        if kind == 0:
+            names.append('MESSIER{:03d}'.format(i % 110 + 1))
+        if kind <= 1:
+            names.append('NGC{:04d}'.format(i % 7840 + 1))
+        if kind <= 2:
+            names.append('IC{:04d}'.format(i % 5386 + 1))
+        names.append('SDSSJ{:012d}'.format(i))
+        return names
+
+    def write_galaxies_json(self, file):
+        with open(file, 'w', encoding='utf-8') as f:
+            f.write('{"galaxies": [\n')
+            for i in range(self.n):
+                gal = { 'name': self.names(i)[-2 if self.kind[i] < 3 else 0],
+                        'al2000': float(self.ra[i]),
+                        'de2000': float(self.dec[i]),
+                        'pa': float(self.pa[i]),
+                        'logd25': float(self.logd25[i]),
+                        'logr25': float(self.logr25[i]),
+                        'mag': float(self.mag[i]),
+                        'descs': [ '{:.2f}億光年'.format(self.v[i] / 7000) ] }
+                f.write((',\n' if i else '') + json.dumps(gal,
+                                                          ensure_ascii=False))
+            f.write('\n]}\n')
+
+    def rows(self):
+        for i in range(self.n):
+            values = [ str(self.pgc[i]), 'SDSSJ{:012d}'.format(i), 'G',
+                       '{:.7f}'.format(self.ra[i]),
+                       '{:.7f}'.format(self.dec[i]),
+                       '{:.1f}'.format(self.pa[i]),
+                       '{:.2f}'.format(self.logd25[i]),
+                       '{:.2f}'.format(self.logr25[i]),
+                       '', '', '{:.3f}'.format(self.mag[i]),
+                       '{:.0f}'.format(self.v[i]), '',
+                       ','.join(self.names(i)) ]
+            yield ('<TR>' + ''.join('<TD>{}</TD>'.format(v) for v in values)
+                   + '</TR>\n').encode()
+
+    def votable_parts(self):
+        head = ('<?xml version="1.0"?>\n<VOTABLE version="1.1">\n'
+                '<RESOURCE type="results">\n'
+                '<INFO name="QUERY_STATUS" value="OK">Successful Search'
+                '</INFO>\n<INFO name="TableRows" value="{}"/>\n<TABLE>\n'
+                .format(self.n) +
+                ''.join('<FIELD name="{}" datatype="char" arraysize="*" />\n'
+                        .format(f) for f in VOTABLE_FIELDS) +
+                '<DATA>\n<TABLEDATA>\n').encode()
+        tail = b'</TABLEDATA>\n</DATA>\n</TABLE>\n</RESOURCE>\n</VOTABLE>\n'
+        return head, tail
+
+    def write_votable(self, file):
+        head, tail = self.votable_parts()
+        with open(file, 'wb') as f:
+            f.write(head)
+            for row in self.rows():
+                f.write(row)
+            f.write(tail)
+
+def make_image(path, size):
+    # JPEG SOI marker followed by incompressible data.
+    with open(path, 'wb') as f:
+        f.write(b'\xff\xd8\xff\xe0')
+        remain = size - 4
+        while remain > 0:
+            n = min(remain, 1024 * 1024)
+            f.write(os.urandom(n))
+            remain -= n
+
+def start_server(votable_xml):
+    """HyperLeda stand-in serving rows of votable_xml in the box of the
+    query."""
+    with open(votable_xml, 'rb') as f:
+        votable = hyperleda.VOTable(f.read())
+    ra = np.array([ float(v) for v in votable.column('al2000') ])
+    dec = np.array([ float(v) for v in votable.column('de2000') ])
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *a):
+            pass
+
+        def do_GET(self):
+            query = urllib.parse.parse_qs(
+                urllib.parse.urlparse(self.path).query)
+            where = query['sql'][0]
+            box = {}
+            for key, op, value in re.findall(
+                    r'(al2000|de2000)([<>])(-?[0-9.e+-]+)', where):
+                box[key + op] = float(value)
+            mask = (ra < box['al2000<']) & (ra > box['al2000>']) & \
+                (dec < box['de2000<']) & (dec > box['de2000>'])
+            body = votable.tobytes([ votable.rows[i]
+                                     for i in np.flatnonzero(mask) ])
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run(cmd):
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        print('ERROR: {} exited with {}'.format(
+            cmd, os.waitstatus_to_exitcode(status)), file=sys.stderr)
+        sys.exit(1)
+    # ru_maxrss is in KB on Linux.
+    return elapsed, rusage.ru_maxrss / 1024
+
+def script(name):
+    return [ sys.executable, os.path.join(BASE_DIR, name) ]
+
+tools = args.tools.split(',')
+rng = np.random.default_rng(args.seed)
+with tempfile.TemporaryDirectory() as tmp:
+    image = os.path.join(BASE_DIR, 'test-data', 'test-in.jpg')
+    if args.image_mb:
+        image = os.path.join(tmp, 'image.jpg')
+        make_image(image, int(args.image_mb * 1024 * 1024))
+    if args.stats_dir:
+        os.makedirs(args.stats_dir, exist_ok=True)
+    print('tool,galaxies,seconds,galaxies_per_second,peak_rss_mb')
+    for n in map(int, args.sizes.split(',')):
+        catalog = SyntheticCatalog(n, rng)
+        votable_xml = os.path.join(tmp, 'votable.xml')
+        if 'converter' in tools or 'get-votable' in tools:
+            catalog.write_votable(votable_xml)
+        results = []
+        if 'annotator' in tools:
+            galaxies_json = os.path.join(tmp, 'galaxies.json')
+            catalog.write_galaxies_json(galaxies_json)
+            stats = os.path.join(args.stats_dir, 'annotator-{}.json'.format(
+                n)) if args.stats_dir else os.path.join(tmp, 'stats.json')
+            results.append(('annotator', run(
+                script('galaxy-annotator.py') +
+                [ '-f', '--stats', stats ] + args.options +
+                [ galaxies_json, os.path.join(BASE_DIR, 'sample-style.json'),
+                  WCS_FITS, image, os.path.join(tmp, 'out.svg') ])))
+        if 'converter' in tools:
+            results.append(('converter', run(
+                script('leda-votable-to-galaxy.py') +
+                [ '-f', '-d', '-j', '-M', '-m', '30', votable_xml,
+                  os.path.join(tmp, 'converted.json') ])))
+        if 'get-votable' in tools:
+            server = start_server(votable_xml)
+            url = 'http://127.0.0.1:{}/fG.cgi'.format(server.server_port)
+            results.append(('get-votable', run(
+                script('leda-get-votable.py') +
+                [ '-f', '--no-cache', '--leda-url', url, '-F', WCS_FITS,
+                  os.path.join(tmp, 'fetched.xml') ])))
+            server.shutdown()
+        for tool, (elapsed, rss) in results:
+            print('{},{},{:.3f},{:.0f},{:.1f}'.format(tool, n, elapsed,
+                                                      n / elapsed, rss),
+                  flush=True)
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+"""Lightweight WCS for 'galaxy-annotator.py'.
+
+astrometry.net writes simple TAN or TAN-SIP headers. TanSipWCS reads such a
+header without astropy and evaluates the projection with NumPy, so small
+fields are annotated without the import time of astropy. Other headers are
+handled by AstropyWCS. Both have the same interface:
+
+- pixel_to_world(x, y): RA/Dec (degrees) in the frame of the WCS of
+  0-based pixel coordinates (like astropy's pixel_to_world()).
+- world_to_pixel(ra, dec): pixel coordinates of ICRS RA/Dec (degrees)
+  (like astropy's world_to_pixel() of SkyCoord in the default frame).
+- to_icrs(ra, dec): ICRS RA/Dec of RA/Dec in the frame of the WCS.
+- pixel_scales(): pixel scales (degrees) of the axes.
+- jacobian(x, y): local linear map from pixel offsets to offsets to the
+  east and to the north (degrees) at pixel coordinates.
+
+load_wcs() chooses one of them for a wcs.fits file.
+
+Run this file with a wcs.fits file to compare TanSipWCS with astropy.
+"""
+import sys
+import math
+import numpy as np
+
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+def read_header(file):
+    """Read the primary header of a FITS file as a dict."""
+    header = {}
+    with open(file, 'rb') as f:
+        while True:
+            block = f.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                raise ValueError('{}: END of FITS header not '\
+                                 'found.'.format(file))
+            for i in range(0, FITS_BLOCK, FITS_CARD):
+                card = block[i:i + FITS_CARD].decode('ascii', 'replace')
+                key = card[:8].strip()
+                if key == 'END':
+                    return header
+                if card[8:10] == '= ':
+                    header[key] = parse_value(card[10:])
+
+def parse_value(s):
+    s = s.strip()
+    if s.startswith("'"):
+        # string value ('' is an escaped quote)
+        value = ''
+        i = 1
+        while i < len(s):
+            if s[i] == "'":
+                if s[i + 1:i + 2] == "'":
+                    value += "'"
+                    i += 2
+                    continue
+                break
+            value += s[i]
+            i += 1
+        return value.rstrip()
+    s = s.split('/', 1)[0].strip()
+    if s == 'T':
+        return True
+    if s == 'F':
+        return False
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return float(s.replace('D', 'E'))
+    except ValueError:
+        return s
+
+class UnsupportedWCS(ValueError):
+    pass
+
+def _rx(a):
+    c, s = math.cos(a), math.sin(a)
+    return np.array([[1, 0, 0], [0, c, s], [0, -s, c]])
+
+def _ry(a):
+    c, s = math.cos(a), math.sin(a)
+    return np.array([[c, 0, -s], [0, 1, 0], [s, 0, c]])
+
+def _rz(a):
+    c, s = math.cos(a), math.sin(a)
+    return np.array([[c, s, 0], [-s, c, 0], [0, 0, 1]])
+
+def frame_bias_matrix():
+    """Rotation matrix from ICRS to FK5 (J2000) (USNO circular 179)."""
+    mas = math.pi / 180 / 3600000
+    eta0 = -19.9 * mas
+    xi0 = 9.1 * mas
+    da0 = -22.9 * mas
+    return _rx(-eta0) @ _ry(xi0) @ _rz(da0)
+
+def _to_vector(ra, dec):
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra),
+                     np.sin(dec)])
+
+def _from_vector(v):
+    ra = np.degrees(np.arctan2(v[1], v[0])) % 360
+    dec = np.degrees(np.arctan2(v[2], np.hypot(v[0], v[1])))
+    return ra, dec
+
+def _east_north(ra, dec):
+    """Unit vectors to the east and to the north at RA/Dec (degrees)."""
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    east = np.stack([-np.sin(ra), np.cos(ra), np.zeros(np.shape(ra))])
+    north = np.stack([-np.sin(dec) * np.cos(ra), -np.sin(dec) * np.sin(ra),
+                      np.cos(dec)])
+    return east, north
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """Angular separation (degrees) of RA/Dec (degrees) by Vincenty formula."""
+    ra1, dec1, ra2, dec2 = (np.radians(v) for v in (ra1, dec1, ra2, dec2))
+    d_ra = ra2 - ra1
+    num1 = np.cos(dec2) * np.sin(d_ra)
+    num2 = np.cos(dec1) * np.sin(dec2) - \
+        np.sin(dec1) * np.cos(dec2) * np.cos(d_ra)
+    den = np.sin(dec1) * np.sin(dec2) + np.cos(dec1) * np.cos(dec2) * np.cos(d_ra)
+    return np.degrees(np.arctan2(np.hypot(num1, num2), den))
+
+class SIP:
+    """SIP polynomial of a header (A/B or AP/BP)."""
+    def __init__(self, header, a, b):
+        self.a = self._coefficients(header, a)
+        self.b = self._coefficients(header, b)
+
+    @staticmethod
+    def _coefficients(header, name):
+        order = header.get(name + '_ORDER')
+        if order is None:
+            return []
+        return [ (p, q, float(header[f'{name}_{p}_{q}']))
+                 for p in range(order + 1) for q in range(order + 1 - p)
+                 if header.get(f'{name}_{p}_{q}', 0) != 0 ]
+
+    @staticmethod
+    def _eval(coefficients, u, v):
+        return sum((c * u ** p * v ** q for p, q, c in coefficients),
+                   np.zeros(np.shape(u)))
+
+    @staticmethod
+    def _eval_du(coefficients, u, v):
+        return sum((c * p * u ** (p - 1) * v ** q
+                    for p, q, c in coefficients if p > 0),
+                   np.zeros(np.shape(u)))
+
+    @staticmethod
+    def _eval_dv(coefficients, u, v):
+        return sum((c * q * u ** p * v ** (q - 1)
+                    for p, q, c in coefficients if q > 0),
+                   np.zeros(np.shape(u)))
+
+    def __call__(self, u, v):
+        return u + self._eval(self.a, u, v), v + self._eval(self.b, u, v)
+
+    def jacobian(self, u, v):
+        return (1 + self._eval_du(self.a, u, v), self._eval_dv(self.a, u, v),
+                self._eval_du(self.b, u, v), 1 + self._eval_dv(self.b, u, v))
+
+class TanSipWCS:
+    """TAN (gnomonic) projection with optional SIP distortion."""
+    def __init__(self, header):
+        ctype = (header.get('CTYPE1', ''), header.get('CTYPE2', ''))
+        if not(ctype in [('RA---TAN', 'DEC--TAN'),
+                         ('RA---TAN-SIP', 'DEC--TAN-SIP')]):
+            raise UnsupportedWCS('projection {} is not supported.'.format(
+                ctype))
+        if header.get('WCSAXES', 2) != 2:
+            raise UnsupportedWCS('only 2 axes are supported.')
+        if header.get('LONPOLE', 180.0) != 180.0 or \
+           any(k.startswith(('PV', 'PS', 'DP', 'DQ', 'CPDIS', 'CQDIS'))
+               for k in header):
+            raise UnsupportedWCS('LONPOLE, PV or other distortions are not '\
+                                 'supported.')
+        for unit in ('CUNIT1', 'CUNIT2'):
+            if header.get(unit, 'deg').strip() not in ('deg', ''):
+                raise UnsupportedWCS('unit {} is not supported.'.format(
+                    header[unit]))
+        radesys = header.get('RADESYS', header.get('RADECSYS'))
+        equinox = header.get('EQUINOX', header.get('EPOCH'))
+        if radesys is None:
+            # same defaults as astropy (FITS WCS paper II).
+            radesys = 'ICRS' if equinox is None else \
+                ('FK5' if equinox >= 1984 else 'FK4')
+        if radesys == 'ICRS':
+            self.bias = None
+        elif radesys == 'FK5' and (equinox is None or equinox == 2000):
+            self.bias = frame_bias_matrix()
+        else:
+            raise UnsupportedWCS('frame {} (equinox {}) is not '\
+                                 'supported.'.format(radesys, equinox))
+
+        self.crpix = np.array([header['CRPIX1'], header['CRPIX2']],
+                              dtype=float)
+        self.crval = np.array([header['CRVAL1'], header['CRVAL2']],
+                              dtype=float)
+        if 'CD1_1' in header:
+            cd = [[header.get('CD1_1', 0), header.get('CD1_2', 0)],
+                  [header.get('CD2_1', 0), header.get('CD2_2', 0)]]
+        else:
+            pc = [[header.get('PC1_1', 1), header.get('PC1_2', 0)],
+                  [header.get('PC2_1', 0), header.get('PC2_2', 1)]]
+            cdelt = [header.get('CDELT1', 1), header.get('CDELT2', 1)]
+            cd = [[pc[0][0] * cdelt[0], pc[0][1] * cdelt[0]],
+                  [pc[1][0] * cdelt[1], pc[1][1] * cdelt[1]]]
+        self.cd = np.array(cd, dtype=float)
+        self.cd_inv = np.linalg.inv(self.cd)
+        self.sip = None
+        self.inv_sip = None
+        if ctype[0].endswith('-SIP'):
+            self.sip = SIP(header, 'A', 'B')
+            if 'AP_ORDER' in header:
+                self.inv_sip = SIP(header, 'AP', 'BP')
+
+    def pixel_to_world(self, x, y):
+        u = np.asarray(x, dtype=float) + 1 - self.crpix[0]
+        v = np.asarray(y, dtype=float) + 1 - self.crpix[1]
+        if self.sip:
+            u, v = self.sip(u, v)
+        xi = np.radians(self.cd[0, 0] * u + self.cd[0, 1] * v)
+        eta = np.radians(self.cd[1, 0] * u + self.cd[1, 1] * v)
+        ra0, dec0 = np.radians(self.crval)
+        den = math.cos(dec0) - eta * math.sin(dec0)
+        ra = np.degrees(ra0 + np.arctan2(xi, den)) % 360
+        dec = np.degrees(np.arctan2(math.sin(dec0) + eta * math.cos(dec0),
+                                    np.hypot(xi, den)))
+        return ra, dec
+
+    def to_icrs(self, ra, dec):
+        if self.bias is None:
+            return ra, dec
+        return _from_vector(np.tensordot(self.bias.T, _to_vector(ra, dec),
+                                         axes=1))
+
+    def world_to_pixel(self, ra, dec):
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        if self.bias is not None:
+            ra, dec = _from_vector(np.tensordot(self.bias,
+                                                _to_vector(ra, dec), axes=1))
+        ra0, dec0 = np.radians(self.crval)
+        d_ra = np.radians(ra) - ra0
+        dec = np.radians(dec)
+        cos_c = math.sin(dec0) * np.sin(dec) + \
+            math.cos(dec0) * np.cos(dec) * np.cos(d_ra)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xi = np.degrees(np.cos(dec) * np.sin(d_ra) / cos_c)
+            eta = np.degrees((math.cos(dec0) * np.sin(dec) -
+                              math.sin(dec0) * np.cos(dec) * np.cos(d_ra)) /
+                             cos_c)
+            # points on the other side of the sky are not projected.
+            xi = np.where(cos_c > 0, xi, np.nan)
+            eta = np.where(cos_c > 0, eta, np.nan)
+        up = self.cd_inv[0, 0] * xi + self.cd_inv[0, 1] * eta
+        vp = self.cd_inv[1, 0] * xi + self.cd_inv[1, 1] * eta
+        u, v = up, vp
+        if self.sip:
+            if self.inv_sip:
+                u, v = self.inv_sip(up, vp)
+            # solve sip(u, v) = (up, vp) by Newton's method.
+            for i in range(20):
+                fu, fv = self.sip(u, v)
+                ru = fu - up
+                rv = fv - vp
+                j11, j12, j21, j22 = self.sip.jacobian(u, v)
+                det = j11 * j22 - j12 * j21
+                du = (j22 * ru - j12 * rv) / det
+                dv = (j11 * rv - j21 * ru) / det
+                u = u - du
+                v = v - dv
+                if not(np.nanmax(np.abs(du), initial=0) > 1e-10 or
+                       np.nanmax(np.abs(dv), initial=0) > 1e-10):
+                    break
+        return u + self.crpix[0] - 1, v + self.crpix[1] - 1
+
+    def pixel_scales(self):
+        return tuple(np.sqrt((self.cd ** 2).sum(axis=0)))
+
+    def jacobian(self, x, y):
+        """Derivatives (degrees per pixel) of the offsets to the east and to
+        the north by x and y at pixel coordinates (x, y) as (de/dx, de/dy,
+        dn/dx, dn/dy)."""
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float),
+                                   np.asarray(y, dtype=float))
+        u = x.ravel() + 1 - self.crpix[0]
+        v = y.ravel() + 1 - self.crpix[1]
+        s11, s12, s21, s22 = 1, 0, 0, 1
+        if self.sip:
+            s11, s12, s21, s22 = self.sip.jacobian(u, v)
+            u, v = self.sip(u, v)
+        # derivatives of the standard coordinates (xi, eta) by pixels.
+        cd = self.cd
+        a11 = cd[0, 0] * s11 + cd[0, 1] * s21
+        a12 = cd[0, 0] * s12 + cd[0, 1] * s22
+        a21 = cd[1, 0] * s11 + cd[1, 1] * s21
+        a22 = cd[1, 0] * s12 + cd[1, 1] * s22
+        # point of the tangent plane (t + xi e1 + eta e2) projected to the
+        # sphere, and its derivatives by xi and eta (radians).
+        t = _to_vector(*self.crval)[:, np.newaxis]
+        e1, e2 = (e[:, np.newaxis] for e in _east_north(*self.crval))
+        xi = np.radians(cd[0, 0] * u + cd[0, 1] * v)
+        eta = np.radians(cd[1, 0] * u + cd[1, 1] * v)
+        w = t + xi * e1 + eta * e2
+        n = np.sqrt((w ** 2).sum(axis=0))
+        p = w / n
+        dp_dxi = (e1 - p * (p * e1).sum(axis=0)) / n
+        dp_deta = (e2 - p * (p * e2).sum(axis=0)) / n
+        east, north = _east_north(*_from_vector(p))
+        b11 = (east * dp_dxi).sum(axis=0)
+        b12 = (east * dp_deta).sum(axis=0)
+        b21 = (north * dp_dxi).sum(axis=0)
+        b22 = (north * dp_deta).sum(axis=0)
+        return tuple(j.reshape(x.shape) for j in
+                     (b11 * a11 + b12 * a21, b11 * a12 + b12 * a22,
+                      b21 * a11 + b22 * a21, b21 * a12 + b22 * a22))
+
+class AstropyWCS:
+    """WCS by astropy (for headers TanSipWCS doesn't support)."""
+    def __init__(self, wcs):
+        from astropy.wcs import WCS
+        if isinstance(wcs, str):
+            from astropy.io import fits
+            wcs = fits.open(wcs)[0].header
+        self.w = WCS(wcs, fix=False)
+
+    def pixel_to_world(self, x, y):
+        sky = self.w.pixel_to_world(x, y)
+        return sky.spherical.lon.deg, sky.spherical.lat.deg
+
+    def to_icrs(self, ra, dec):
+        from astropy.coordinates import SkyCoord
+        frame = self.w.pixel_to_world(0, 0).frame
+        sky = SkyCoord(frame.realize_frame(
+            self._spherical(np.asarray(ra), np.asarray(dec)))).icrs
+        return sky.ra.deg, sky.dec.deg
+
+    @staticmethod
+    def _spherical(ra, dec):
+        from astropy import units as u
+        from astropy.coordinates import UnitSphericalRepresentation
+        return UnitSphericalRepresentation(ra * u.deg, dec * u.deg)
+
+    def world_to_pixel(self, ra, dec):
+        from astropy import units as u
+        from astropy.coordinates import SkyCoord
+        return self.w.world_to_pixel(SkyCoord(ra=ra * u.deg, dec=dec * u.deg))
+
+    def pixel_scales(self):
+        from astropy import units as u
+        return tuple(s.to_value(unit=u.deg)
+                     for s in self.w.proj_plane_pixel_scales())
+
+    def jacobian(self, x, y, step=0.5):
+        """Same as TanSipWCS.jacobian() by central differences of
+        pixel_to_world() of all points at once."""
+        return finite_difference_jacobian(self, x, y, step)
+
+def finite_difference_jacobian(w, x, y, step=0.5):
+    """Jacobian of w (as TanSipWCS.jacobian()) by central differences of
+    w.pixel_to_world() with step pixels."""
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=float),
+                               np.asarray(y, dtype=float))
+    x0 = x.ravel()
+    y0 = y.ravel()
+    ra, dec = w.pixel_to_world(np.concatenate([x0 + step, x0 - step, x0, x0]),
+                               np.concatenate([y0, y0, y0 + step, y0 - step]))
+    v = _to_vector(ra, dec).reshape(3, 4, -1)
+    # offsets along the east and north unit vectors at the middle point.
+    east, north = _east_north(*_from_vector(v.sum(axis=1)))
+    dv_dx = np.degrees(v[:, 0] - v[:, 1]) / (2 * step)
+    dv_dy = np.degrees(v[:, 2] - v[:, 3]) / (2 * step)
+    return tuple(j.reshape(x.shape) for j in
+                 ((east * dv_dx).sum(axis=0), (east * dv_dy).sum(axis=0),
+                  (north * dv_dx).sum(axis=0), (north * dv_dy).sum(axis=0)))
+
+def load_wcs(wcs, use_astropy=False):
+    """Load WCS of wcs (path of a wcs.fits file or its header as a dict or
+    astropy Header). returns a tuple of the WCS and header."""
+    header = read_header(wcs) if isinstance(wcs, str) else wcs
+    if not use_astropy:
+        try:
+            return TanSipWCS(header), header
+        except UnsupportedWCS:
+            pass
+    return AstropyWCS(wcs), header
+
+if __name__ == '__main__':
+    # compare TanSipWCS with astropy on a grid of pixels.
+    import warnings
+    warnings.simplefilter('ignore')
+    file = sys.argv[1]
+    header = read_header(file)
+    fast = TanSipWCS(header)
+    ref = AstropyWCS(file)
+    w, h = header['IMAGEW'], header['IMAGEH']
+    x, y = np.meshgrid(np.linspace(-0.5 * w, 1.5 * w, 101),
+                       np.linspace(-0.5 * h, 1.5 * h, 101))
+    x = x.ravel()
+    y = y.ravel()
+    ra, dec = ref.pixel_to_world(x, y)
+    ra_f, dec_f = fast.pixel_to_world(x, y)
+    d_sky = np.hypot((ra_f - ra) * np.cos(np.radians(dec)), dec_f - dec)
+    print('pixel_to_world: max error {:.3g} arcsec'.format(
+        d_sky.max() * 3600))
+    ra_i, dec_i = ref.to_icrs(ra, dec)
+    x_r, y_r = ref.world_to_pixel(ra_i, dec_i)
+    x_f, y_f = fast.world_to_pixel(ra_i, dec_i)
+    print('world_to_pixel: max error {:.3g} pixels'.format(
+        np.hypot(x_f - x_r, y_f - y_r).max()))
+    ra_fi, dec_fi = fast.to_icrs(ra, dec)
+    print('to_icrs: max error {:.3g} arcsec'.format(
+        np.hypot((ra_fi - ra_i) * np.cos(np.radians(dec)),
+                 dec_fi - dec_i).max() * 3600))
+    print('pixel_scales: {} (astropy: {})'.format(fast.pixel_scales(),
+                                                  ref.pixel_scales()))
+    j = np.array(fast.jacobian(x, y))
+    j_fd = np.array(finite_difference_jacobian(ref, x, y))
+    print('jacobian: max error {:.3g} (relative to finite differences of '\
+          'astropy)'.format(np.abs(j - j_fd).max() / np.abs(j_fd).max()))
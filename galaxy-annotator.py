@@ -1,434 +1,397 @@
 #!/usr/bin/env python
+import time
+# start time of the script (for --profile-startup).
+START_TIME = time.perf_counter()
 import sys
+import os
 import os.path
-import math
-import json
 import copy
-import re
-from functools import reduce
+import glob
+import shlex
 from argparse import ArgumentParser
+from annotator import Annotator, StageTimer
+IMPORTED_TIME = time.perf_counter()
 
 argparser = ArgumentParser(description='Convert votable.xml to galaxies.json '\
                            "for 'galaxy-annotator.py'.")
 argparser.add_argument('galaxies_json', metavar='galaxies.json',
-                       help="annotation data file.")
+                       help="annotation data file (galaxies.json or "\
+                       "binary catalog).")
 argparser.add_argument('style_json', metavar='style.json',
                        help="style sttings.")
-argparser.add_argument('wcs_fits', metavar='wcs.fits',
+argparser.add_argument('wcs_fits', metavar='wcs.fits', nargs='?',
                        help="wcs file(output of astrometry.net in FITS format).")
-argparser.add_argument('image_file', metavar='image_file',
+argparser.add_argument('image_file', metavar='image_file', nargs='?',
                        help="image file(input of astrometry.net in image format "\
                        "(JPEG/PNG etc.)).")
-argparser.add_argument('out_file', metavar='out.svg',
-                       help="output image file in SVG format.")
+argparser.add_argument('out_file', metavar='out.svg', nargs='?',
+                       help="output image file in SVG format (or PNG/JPEG "\
+                       "format by extension '.png', '.jpg' or '.jpeg').")
 argparser.add_argument("-f", "--force-overwrite", action="store_true",
                        help="force overwriting to output image file.")
+argparser.add_argument("-l", "--link-image", action="store_true",
+                       help="link image file by relative path from output "\
+                       "file instead of embedding it.")
+argparser.add_argument("-r", "--raster", metavar="FILE",
+                       help="also write annotated image in PNG/JPEG format "\
+                       "(by extension) to FILE.")
+argparser.add_argument("--font", metavar="FONT_FILE",
+                       help="font file for PNG/JPEG output (default: font "\
+                       "found by fc-match for font-family of the style).")
+argparser.add_argument("-z", "--deep-zoom", dest="deep_zoom", metavar="DIR",
+                       help="write tile pyramid of the image in Deep Zoom "\
+                       "(DZI) format and annotations as GeoJSON-like "\
+                       "features in pixel coordinates to DIR (out.svg can "\
+                       "be omitted).")
+argparser.add_argument("--tile-size", dest="tile_size", type=int, default=256,
+                       metavar="PX",
+                       help="tile size in pixels for --deep-zoom "\
+                       "(default: 256).")
+argparser.add_argument("--stream", action="store_true",
+                       help="write SVG elements to output file as they are "\
+                       "generated instead of building whole SVG in memory.")
+argparser.add_argument("--no-pretty", dest="pretty", action="store_false",
+                       default=True,
+                       help="do not indent output SVG (faster for large "\
+                       "output).")
+argparser.add_argument("-i", "--incremental", action="store_true",
+                       help="keep a cache of the image encoding, positions "\
+                       "and SVG elements of galaxies in 'out.svg.cache' and "\
+                       "redo only galaxies whose data, style or WCS changed "\
+                       "(output is the same. not used with -r, -z, -v and "\
+                       "--debug).")
+argparser.add_argument("--index", metavar="INDEX",
+                       help="galaxy index file for searching galaxies in the "\
+                       "field of view. built from galaxies.json and saved if "\
+                       "missing or outdated.")
+argparser.add_argument("-b", "--batch", metavar="MANIFEST",
+                       help="batch mode. annotate all frames listed in "\
+                       "MANIFEST (one 'wcs.fits image_file [out.svg]' per "\
+                       "line) instead of wcs.fits, image_file and out.svg.")
+argparser.add_argument("-g", "--batch-glob", metavar="PATTERN",
+                       help="batch mode. annotate all frames whose wcs "\
+                       "file matches PATTERN (e.g. 'frames/*.wcs'). image "\
+                       "file of each frame is searched by the same base "\
+                       "name.")
+argparser.add_argument("-w", "--watch", metavar="DIR",
+                       help="watch mode. keep running and annotate each frame "\
+                       "as soon as its wcs file (matching --watch-pattern) "\
+                       "appears in DIR. image file is searched as in "\
+                       "--batch-glob.")
+argparser.add_argument("--watch-pattern", dest="watch_pattern",
+                       default='*.wcs', metavar="PATTERN",
+                       help="pattern of wcs files for --watch (default: "\
+                       "'*.wcs').")
+argparser.add_argument("--poll-interval", dest="poll_interval", type=float,
+                       default=0.1, metavar="SEC",
+                       help="interval of polling DIR for --watch (default: "\
+                       "0.1).")
+argparser.add_argument("-o", "--out-dir", metavar="DIR",
+                       help="output directory for batch mode (default: "\
+                       "directory of each image file).")
+argparser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                       metavar="N",
+                       help="number of worker processes for batch mode "\
+                       "(default: number of CPUs).")
+argparser.add_argument("-a", "--auto-label-position", action="store_true",
+                       help="choose label position of each galaxy from the "\
+                       "nine positions to avoid overlapping of labels and "\
+                       "markers.")
+argparser.add_argument("--lod", type=int, metavar="N",
+                       help="level of detail. draw only N most significant "\
+                       "galaxies in each cell of the image.")
+argparser.add_argument("--lod-cell", dest="lod_cell", type=float, default=256,
+                       metavar="PX",
+                       help="cell size in pixels for --lod (default: 256).")
+argparser.add_argument("--lod-rank", dest="lod_rank", default='mag',
+                       choices=['mag', 'size'],
+                       help="significance of galaxies for --lod. 'mag': "\
+                       "brighter \"mag\" first, 'size': larger \"logd25\" "\
+                       "first (default: mag. galaxies without \"mag\" are "\
+                       "ranked by size after others).")
+argparser.add_argument("--lod-layers", dest="lod_layers", action="store_true",
+                       help="draw galaxies not selected by --lod in a "\
+                       "separate layer (<g id=\"faint-galaxies\">) instead "\
+                       "of omitting them.")
+argparser.add_argument("--astropy-wcs", dest="astropy_wcs",
+                       action="store_true",
+                       help="always use astropy for WCS (by default, TAN and "\
+                       "TAN-SIP projections are computed without astropy "\
+                       "for faster startup).")
+argparser.add_argument("--global-marker-geometry",
+                       dest="global_marker_geometry", action="store_true",
+                       help="compatibility option to size and rotate all "\
+                       "markers by the pixel scale and tilt of the whole "\
+                       "image (v0.9.4 or earlier) instead of the local ones "\
+                       "at each galaxy.")
+argparser.add_argument("--profile-startup", dest="profile_startup",
+                       action="store_true",
+                       help="print time spent in importing modules and in "\
+                       "computing to stderr.")
+argparser.add_argument("--stats", metavar="FILE",
+                       help="write elapsed time and memory usage of each "\
+                       "stage and numbers of galaxies as JSON to FILE ('-' "\
+                       "for standard output).")
+argparser.add_argument("-v", "--verbose", action="store_true",
+                       help="print position, size and label positions of "\
+                       "each galaxy.")
 argparser.add_argument("--debug", action="store_true",
-                       help="debug mode.")
-args = argparser.parse_args()
-if not args.out_file:
-    argparser.print_help(sys.stderr)
-    exit(1)
+                       help="debug mode (also prints the same as "\
+                       "--verbose).")
+IMAGE_EXTENSIONS = [ '.jpg', '.jpeg', '.png', '.tif', '.tiff', '.webp' ]
 
-galaxies_json = args.galaxies_json
-style_json = args.style_json
-wcs_fits = args.wcs_fits
-image_file = args.image_file
-out_file = args.out_file
-debug = args.debug
+def batch_out_file(image_file, out_dir):
+    base = os.path.splitext(os.path.basename(image_file))[0] + '.svg'
+    return os.path.join(out_dir or os.path.dirname(image_file), base)
 
-with open(galaxies_json, 'r', encoding='utf-8') as f:
-    galaxies = json.load(f)
+def read_manifest(manifest, out_dir):
+    frames = []
+    with open(manifest, 'r', encoding='utf-8') as f:
+        for n, line in enumerate(f, 1):
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            if not(len(fields) in [2, 3]):
+                print('{}:{}: ERROR: frame must be "wcs.fits image_file '\
+                      '[out.svg]".'.format(manifest, n), file=sys.stderr)
+                sys.exit(1)
+            if len(fields) == 2:
+                fields.append(batch_out_file(fields[1], out_dir))
+            frames.append(tuple(fields))
+    return frames
 
-SVG_LENGTH_PROPS = [ 'baseline-shift', 'font-size', 'kerning', 'letter-spacing',
-                     'stroke-dashoffset', 'stroke-width', 'stroke-width',
-                     'word-spacing' ]
+def find_image_file(wcs_fits):
+    base = os.path.splitext(wcs_fits)[0]
+    for ext in IMAGE_EXTENSIONS:
+        for image_file in [base + ext, base + ext.upper()]:
+            if os.path.exists(image_file):
+                return image_file
+    return None
 
-non_svg_marker_style_defaults = {
-    'size': 1.5,
-    'min-size': None,
-    'min-r': 15,
-    'min-size-r': None,
-    'x-margin': 4,
-    'y-margin': 0,
-    'label-position': 'top-right',
-    'label-vertical-align': 'auto'
-}
-non_svg_desc_style_defaults = {
-    'line-height': 1
-}
-style = {
-    'marker': {
-        'fill': 'none',
-        'stroke': 'gray',
-        'stroke-width': 1
-    },
-    'name': {
-        'font-size': 40,
-        'fill': 'gray',
-        'direction': 'ltr'
-    },
-    'desc': [
-        {
-            'font-size': 40,
-            'fill': 'gray',
-            'direction': 'ltr'
-        }
-    ]
-}
-style['marker'].update(non_svg_marker_style_defaults)
+def glob_frames(pattern, out_dir):
+    frames = []
+    for wcs_fits in sorted(glob.glob(pattern)):
+        image_file = find_image_file(wcs_fits)
+        out_file = batch_out_file(image_file or wcs_fits, out_dir)
+        frames.append((wcs_fits, image_file, out_file))
+    return frames
 
-def update_style(s, s_diff):
-    for key in iter(s):
-        if not key in s_diff:
-            continue
-        v = s[key]
-        if type(v) == dict:
-            v.update(s_diff[key]) 
-        elif type(v) == list:
-            for i, e in enumerate(s_diff[key]):
-                if len(v) > i:
-                    v[i].update(e)
-                else:
-                    v.append(e)
-        else:
-            s[key] = s_diff[key]
-    for ds in s['desc']:
-        for k in non_svg_desc_style_defaults:
-            if not(k in ds):
-                ds[k] = non_svg_desc_style_defaults[k]
+batch_annotator = None
 
-def s_to_ss(selector, s):
-    ss = selector + ' {\n' if selector else ''
-    for prop in s:
-        if prop in non_svg_marker_style_defaults:
-            continue
-        if prop in non_svg_desc_style_defaults:
-            continue
-        v = s[prop]
-        ss += "  " + prop + ": "
-        if (type(v) == int or type(v) == float) and prop in SVG_LENGTH_PROPS:
-            ss += "{}px".format(v)
-        elif type(v) == str and prop == 'font-family':
-            ss += '\"{}\"'.format(v)
-        else:
-            ss += str(v)
-        ss += ';\n' if selector else ';'
-    if selector:
-        ss += '}\n'
-    return ss
+def init_batch_worker(annotator):
+    global batch_annotator
+    # the annotator (and styles resolved in a frame) is reused in the
+    # following frames.
+    batch_annotator = annotator
+    # import modules used by annotate() before the first frame.
+    import svgwrite
+    import fast_wcs
 
-POS_RE = re.compile('(top|middle|bottom)-(left|middle|right)')
-def parse_label_position(value, file):
-    res = POS_RE.match(value)
-    if not(res):
-        print('{}: ERROR: "label-position" of "marker" '\
-              'is invalid.'.format(file), file=sys.stderr)
-        sys.exit(1)
-    else:
-        return [res.group(2), res.group(1)]
+def annotate_batch_frame(frame):
+    wcs_fits, image_file, out_file = frame
+    if not image_file:
+        raise FileNotFoundError('no image file for ' + wcs_fits)
+    if os.path.exists(out_file) and not batch_annotator.opts.force_overwrite:
+        raise FileExistsError("output file '" + out_file + "' exists")
+    batch_annotator.write(wcs_fits, image_file, out_file)
+    return out_file
 
-def get_label_anchor(xpos):
-    # TBD: label_anchor for rtl language.
-    if xpos == 'left':
-        return 'end'
-    elif xpos == 'right':
-        return 'start'
-    elif xpos == 'middle':
-        return 'middle'
-
-VALIGN_RE = re.compile('(auto|baseline|top|middle|bottom)')
-def parse_label_valign(value, file):
-    res = VALIGN_RE.match(value)
-    if not(res):
-        print('{}: ERROR: "label-vertical-align" of "marker" '\
-              'is invalid.'.format(file), file=sys.stderr)
-        sys.exit(1)
+def run_batch(frames, annotator, jobs):
+    results = []
+    if jobs > 1 and len(frames) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 initializer=init_batch_worker,
+                                 initargs=(annotator,)) as executor:
+            futures = [executor.submit(annotate_batch_frame, frame)
+                       for frame in frames]
+            for frame, future in zip(frames, futures):
+                try:
+                    results.append((frame, future.result(), None))
+                except (Exception, SystemExit) as e:
+                    results.append((frame, None, e))
     else:
-        return res.group(1)    
-
-with open(style_json, 'r', encoding='utf-8') as f:
-    update_style(style, json.load(f))
+        init_batch_worker(annotator)
+        for frame in frames:
+            try:
+                results.append((frame, annotate_batch_frame(frame), None))
+            except (Exception, SystemExit) as e:
+                results.append((frame, None, e))
 
-if not (type(style['name']['font-size']) == int or
-        type(style['name']['font-size']) == float):
-    print('{}: ERROR: "font-size" of "name" '\
-          'must be of numeric type.'.format(style_json), file=sys.stderr)
-    sys.exit(1)
-for i, desc in enumerate(style['desc']):
-    if not (type(desc['font-size']) == int or type(desc['font-size']) == float):
-        print('{}: ERROR: "font-size" of "desc"[{}] must be of '\
-              'numeric type.'.format(style_json, i), file=sys.stderr)
-        sys.exit(1)
-
-parse_label_valign(style['marker']['label-vertical-align'], style_json)
-def_label_position = style['marker']['label-position']
-def_x_pos, def_y_pos = parse_label_position(def_label_position, style_json)
-def_label_anchor = get_label_anchor(def_x_pos)
-if not('text-anchor' in style['name']):
-    style['name']['text-anchor'] = def_label_anchor
-
-style_sheet = "\n"
-style_sheet += s_to_ss('ellipse.marker', style['marker'])
-style_sheet += s_to_ss('text.name', style['name'])
-for i, desc in enumerate(style['desc']):
-    if not('text-anchor' in desc):
-        desc['text-anchor'] = def_label_anchor
-    style_sheet += s_to_ss('text.desc{}'.format(i), desc)
-
-if debug:
-    style_sheet += '''
-.debug_marker { fill: none; stroke: white; stroke-width: 2px; stroke-opacity: 0.8; }
-.debug_margin { fill: none; stroke: white; stroke-width: 1.5px; stroke-opacity: 0.8; stroke-dasharray: 8;}
-.debug_centerline { fill: none; stroke: white; stroke-width: 1.5px; stroke-opacity: 0.6; stroke-dasharray: 8 4;}
-.debug_baseline { fill: none; stroke: white; stroke-width: 1.5px; stroke-opacity: 0.8; stroke-dasharray: 16;}
-.debug_middleline { fill: none; stroke: white; stroke-width: 1.5px; stroke-opacity: 0.6; stroke-dasharray: 8 4;}
-.debug_label { fill: none; stroke: white; stroke-width: 2px; stroke-opacity: 0.8; }
-'''
-
-if out_file and os.path.exists(out_file) and (not args.force_overwrite):
-    input = input("output file '" + out_file + "' exists. overwrite? > ")
-    if input.upper() != 'YES':
-        print('bye.')
-        sys.exit(1)
-
-import base64
-import svgwrite
-from astropy import units as u
-from astropy.io import fits
-from astropy.wcs import WCS
-from astropy.coordinates import SkyCoord
-
-hdu = fits.open(wcs_fits)[0]
-w = WCS(hdu.header, fix=False)
-image_w = hdu.header['IMAGEW']
-image_h = hdu.header['IMAGEH']
-
-sky_left = w.pixel_to_world(0, 0)
-sky_right = w.pixel_to_world(image_w, 0)
-sky_right2 = SkyCoord(ra=sky_right.ra, dec=sky_left.dec)
-x2, y2 = w.world_to_pixel(sky_right2)
-image_tilt = math.degrees(math.atan(y2 / x2))
-print('tilt=', image_tilt)
-scales = w.proj_plane_pixel_scales()
-px_scale = (scales[0].to_value(unit=u.deg) + scales[1].to_value(unit=u.deg)) / 2
-print('scale=', px_scale)
+    print('batch summary:')
+    failed = 0
+    for frame, out_file, error in results:
+        if error is None:
+            print('  OK: {} -> {}'.format(frame[0], out_file))
+        else:
+            failed += 1
+            print('  FAILED: {}: {}'.format(frame[0], error or repr(error)))
+    print('{} succeeded, {} failed.'.format(len(results) - failed, failed))
+    return failed == 0
 
-drw = svgwrite.Drawing(out_file, size=(image_w, image_h))
-drw.add(drw.style(style_sheet))
+class FrameWatcher:
+    """Finds frames in a directory whose wcs file appeared or was updated
+    since the last poll.
 
-#TBD: select embed or link by option.
-embed_image = True
-if embed_image:
-    with open(image_file, 'rb') as f:
-        mime = ''
-        if image_file.upper().endswith('.JPG'):
-            mime = 'image/jpeg'
-        elif image_file.upper().endswith('.PNG'):
-            mime = 'image/png'
-        image_data = 'data:' + mime + ';base64,'
-        image_data += base64.standard_b64encode(f.read()).decode()
-    drw.add(drw.image(image_data))
-else:
-    drw.add(drw.image(image_file))
+    A wcs file is taken when its size and mtime are unchanged for one poll
+    (i.e. it is not being written) and its image file exists. Frames whose
+    output file is newer than the wcs file are skipped unless force.
+    """
+    def __init__(self, directory, pattern, out_dir, force=False):
+        self.pattern = os.path.join(glob.escape(directory), pattern)
+        self.out_dir = out_dir
+        self.force = force
+        self.stamps = {}
+        self.taken = {}
 
-for gal in galaxies['galaxies']:
-    sky = SkyCoord(ra=float(gal['al2000']), dec=float(gal['de2000']),
-                   unit=(u.hourangle, u.deg))
-    x, y = w.world_to_pixel(sky)
-    x, y = float(x), float(y)
-    if x < 0 or y < 0 or x > image_w or y > image_h:
-        continue
+    def poll(self):
+        frames = []
+        for wcs_fits in sorted(glob.glob(self.pattern)):
+            try:
+                st = os.stat(wcs_fits)
+            except FileNotFoundError:
+                continue
+            stamp = (st.st_size, st.st_mtime_ns)
+            if self.taken.get(wcs_fits) == stamp:
+                continue
+            if self.stamps.get(wcs_fits) != stamp:
+                self.stamps[wcs_fits] = stamp
+                continue
+            image_file = find_image_file(wcs_fits)
+            if not image_file:
+                continue
+            self.taken[wcs_fits] = stamp
+            out_file = batch_out_file(image_file, self.out_dir)
+            if not self.force and os.path.exists(out_file) and \
+               os.stat(out_file).st_mtime_ns >= st.st_mtime_ns:
+                continue
+            frames.append((wcs_fits, image_file, out_file))
+        return frames
 
-    x_pos = def_x_pos
-    y_pos = def_y_pos
-    
-    gal_style = copy.deepcopy(style)
-    marker_ss = None
-    name_ss = None
-    desc_ss = None
-    if 'style' in gal:
-        s = gal['style']
-        s_label_position = None
-        if 'marker' in s:
-            s_label_position = s['marker']['label-position'] \
-                               if ('label-position' in s['marker']) else None
-            if s_label_position:
-                x_pos, y_pos = parse_label_position(s_label_position, \
-                                                    galaxies_json)
-                label_anchor = get_label_anchor(x_pos)
-                if not('name' in s):
-                    s['name'] = {}
-                if not('desc' in s):
-                    s['desc'] = []
-                n = len(s['desc'])
-                for i, desc in enumerate(gal['descs']):
-                    if i >= n:
-                        s['desc'].append({})
-            marker_ss = s_to_ss(None, s['marker'])
-        if 'name' in s:
-            if not('text-anchor' in s['name']) and s_label_position:
-                s['name']['text-anchor'] = label_anchor
-            name_ss = s_to_ss(None, s['name'])
-        if 'desc' in s:
-            desc_ss = []
-            for i, desc in enumerate(s['desc']):
-                if not('text-anchor' in desc) and s_label_position:
-                    desc['text-anchor'] = label_anchor
-                desc_ss.append(s_to_ss(None, desc))
-        
-        update_style(gal_style, s)
+def run_watch(watcher, annotator, jobs, interval):
+    """Annotate frames found by watcher until interrupted. At most jobs
+    frames are annotated at once, and the directory is not polled while
+    2 * jobs frames are waiting."""
+    from collections import deque
+    from concurrent.futures import wait, FIRST_COMPLETED
+    # annotated frames overwrite outdated output files.
+    annotator = copy.copy(annotator)
+    annotator.opts = copy.copy(annotator.opts)
+    annotator.opts.force_overwrite = True
+    init_batch_worker(annotator)
+    executor = None
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs,
+                                       initializer=init_batch_worker,
+                                       initargs=(annotator,))
+    queue = deque()
+    running = {}
 
-    marker_size = float(gal_style['marker']['size'])
-    label_valign = gal_style['marker']['label-vertical-align']
-    parse_label_valign(label_valign, galaxies_json)
-    
-    svg_group = drw.g()
-    drw.add(svg_group)
-    gal_name = gal['name']
-    print("{name}: ({x}, {y})".format(name=gal_name, x=x, y=y))
-    gal_pa = float(gal['pa']) if gal['pa'] else 0.0
-    gal_d = 10 ** float(gal['logd25']) / 10 / 60 if gal['logd25'] else None
-    gal_r = 10 ** float(gal['logr25']) if gal['logr25'] else 1.0
-    
-    marker_rot = -1.0 * (gal_pa - image_tilt)
-    marker_min_r = gal_style['marker']['min-r']
-    marker_min_size_r = gal_style['marker']['min-size-r'] or (marker_min_r + 1)
-    marker_min_size = gal_style['marker']['min-size'] or marker_size
-    
-    if gal_d:
-        gal_ry = gal_d / 2 / px_scale
-        sz = (gal_ry - marker_min_r) * (marker_min_size - marker_size) / \
-             (marker_min_size_r - marker_min_r) + marker_size
-        marker_ry = max(gal_ry * max(sz, marker_min_size), marker_min_r)
-    else:
-        marker_ry = marker_min_r
-
-    marker_rx = marker_ry / gal_r
-    print("  d={d}".format(d=gal_d))
-    print("  marker: ({rx} x {ry}), rot={rot}".format(rx=marker_rx,
-                                                      ry=marker_ry,
-                                                      rot=marker_rot))
-    transform = "rotate({rot}, {x}, {y})".format(rot=marker_rot, x=x, y=y)
-    ellipse = drw.ellipse(center=(float(x), float(y)),
-                          r=(marker_rx, marker_ry),
-                          transform=transform, class_='marker')
-    if marker_ss:
-        ellipse.update({ 'style': marker_ss })
-    svg_group.add(ellipse)
-    
-    th = math.radians(marker_rot)
-    dx = math.sqrt(marker_rx**2 * math.cos(th)**2 +
-                   marker_ry**2 * math.sin(th)**2)
-    dy = math.sqrt(marker_rx**2 * math.sin(th)**2 +
-                   marker_ry**2 * math.cos(th)**2)
-    
-    x_margin = float(gal_style['marker']['x-margin'])
-    y_margin = float(gal_style['marker']['y-margin'])
+    def report(frame, start, error=None):
+        if error is None:
+            print('OK: {} -> {} ({:.2f} s)'.format(frame[0], frame[2],
+                                                   time.time() - start),
+                  flush=True)
+        else:
+            print('FAILED: {}: {}'.format(frame[0], error or repr(error)),
+                  flush=True)
 
-    if x_pos == 'left':
-        name_x = x - dx - x_margin
-    elif x_pos == 'right':
-        name_x = x + dx + x_margin
-    elif x_pos == 'middle':
-        name_x = x
+    print("watching '{}' (Ctrl-C to stop).".format(watcher.pattern),
+          flush=True)
+    try:
+        while True:
+            if len(queue) < 2 * jobs:
+                # elapsed time is reported since the wcs file was written.
+                queue.extend((frame, watcher.taken[frame[0]][1] / 1e9)
+                             for frame in watcher.poll())
+            if executor is None:
+                while queue:
+                    frame, start = queue.popleft()
+                    try:
+                        annotate_batch_frame(frame)
+                        report(frame, start)
+                    except (Exception, SystemExit) as e:
+                        report(frame, start, e)
+                time.sleep(interval)
+                continue
+            while queue and len(running) < jobs:
+                frame, start = queue.popleft()
+                future = executor.submit(annotate_batch_frame, frame)
+                running[future] = (frame, start)
+            if not running:
+                time.sleep(interval)
+                continue
+            done, not_done = wait(running, timeout=interval,
+                                  return_when=FIRST_COMPLETED)
+            for future in done:
+                frame, start = running.pop(future)
+                error = future.exception()
+                report(frame, start, error)
+    except KeyboardInterrupt:
+        print('bye.')
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
 
-    # y of 'name' baseline 
-    if y_pos == 'top':
-        name_y = y - dy - y_margin
-    elif y_pos == 'bottom':
-        name_y = y + dy + y_margin
-    elif y_pos == 'middle':
-        name_y = y
+if __name__ == '__main__':
+    args = argparser.parse_args()
+    batch = args.batch or args.batch_glob or args.watch
+    if not (batch or args.out_file or args.deep_zoom):
+        argparser.print_help(sys.stderr)
+        exit(1)
+    timer = StageTimer(START_TIME, IMPORTED_TIME) \
+        if args.profile_startup or args.stats else None
 
-    if label_valign == 'auto':
-        label_valign = 'baseline'
-        if x_pos == 'middle':
-            if y_pos == 'top':
-                label_valign = 'bottom'
-            elif y_pos == 'bottom':
-                label_valign = 'top'
-    
-    desc_height = reduce(lambda h, desc: \
-                         h + desc['font-size'] * desc['line-height'],\
-                         gal_style['desc'], 0)
-    # print('desc_height:', desc_height)
-    name_height = float(gal_style['name']['font-size'])
-    
-    if label_valign == 'top':
-        name_y += name_height
-    elif label_valign == 'bottom':
-        name_y -= desc_height
-    elif label_valign == 'middle':
-        name_y += name_height - (name_height + desc_height) / 2
-    
-    print("  name: ({x}, {y})".format(x=name_x, y=name_y))
-    name_text = drw.text(gal_name, x=[name_x], y=[name_y], class_='name')
-    if name_ss:
-        name_text.update({ 'style': name_ss })
-    svg_group.add(name_text)
-    
-    if len(gal['descs']) > 0:
-        desc_x = name_x
-        desc_y = name_y
-        for i, desc in enumerate(gal['descs']):
-            desc_y += gal_style['desc'][i]['font-size'] * \
-                      gal_style['desc'][i]['line-height']
-            print("  desc[{i}]: ({x}, {y})".format(i=i, x=desc_x, y=desc_y))
-            desc_text = drw.text(desc, x=[desc_x], y=[desc_y],
-                                 class_='desc'+str(i))
-            if desc_ss and i < len(desc_ss):
-                desc_text.update({ 'style': desc_ss[i] })
-            svg_group.add(desc_text)
+    if batch:
+        if args.raster:
+            print('ERROR: --raster is not available in batch mode (use '\
+                  'out file names with extension .png/.jpg in MANIFEST).',
+                  file=sys.stderr)
+            sys.exit(1)
+        if args.deep_zoom:
+            print('ERROR: --deep-zoom is not available in batch mode.',
+                  file=sys.stderr)
+            sys.exit(1)
+        if args.stats or args.profile_startup:
+            print('ERROR: --stats and --profile-startup are not available '\
+                  'in batch mode.', file=sys.stderr)
+            sys.exit(1)
+        annotator = Annotator(args.galaxies_json, args.style_json,
+                              index_file=args.index, use_index=True,
+                              opts=args)
+        if args.watch:
+            watcher = FrameWatcher(args.watch, args.watch_pattern,
+                                   args.out_dir, args.force_overwrite)
+            run_watch(watcher, annotator, args.jobs, args.poll_interval)
+            sys.exit(0)
+        if args.batch:
+            frames = read_manifest(args.batch, args.out_dir)
+        else:
+            frames = glob_frames(args.batch_glob, args.out_dir)
+        if not run_batch(frames, annotator, args.jobs):
+            sys.exit(1)
+        sys.exit(0)
 
-    if debug:
-        marker_rect = drw.rect(insert=(x-dx,y-dy), size=(2*dx,2*dy),
-                               class_='debug_marker')
-        margin_rect = drw.rect(insert=(x-dx-x_margin,y-dy-y_margin),
-                               size=(2*(dx+x_margin),2*(dy+y_margin)),
-                               class_='debug_margin')
-        center_line_h = drw.line(start=(x-dx-x_margin,y), end=(x+dx+x_margin,y),
-                                 class_='debug_centerline')
-        center_line_v = drw.line(start=(x,y-dy-y_margin), end=(x,y+dy+y_margin),
-                                 class_='debug_centerline')
-        label_width = name_height*12 # not a real width.
-        name_baseline = drw.line(start=(name_x,name_y),
-                                 end=(name_x+label_width,name_y),
-                                 class_='debug_baseline')
-        middle_y = name_y - name_height + (name_height + desc_height) / 2
-        label_middleline = drw.line(start=(name_x,middle_y),
-                                    end=(name_x+label_width,middle_y),
-                                    class_='debug_middleline')
-        label_rect = drw.rect(insert=(name_x,name_y-name_height),
-                              size=(label_width,name_height+desc_height),
-                              class_='debug_label')
-        if x_pos == 'left':
-            name_baseline.scale(-1, 1)
-            name_baseline.translate(-name_x*2, 0)
-            label_middleline.scale(-1, 1)
-            label_middleline.translate(-name_x*2, 0)
-            label_rect.scale(-1, 1)
-            label_rect.translate(-name_x*2, 0)
-        elif x_pos == 'middle':
-            center_x = name_x + label_width / 2
-            label_centerline = drw.line(start=(center_x,name_y-name_height),
-                                        end=(center_x,name_y+desc_height),
-                                        class_='debug_middleline')
-            name_baseline.translate(-label_width/2, 0)
-            label_middleline.translate(-label_width/2, 0)
-            label_centerline.translate(-label_width/2, 0)
-            label_rect.translate(-label_width/2, 0)
-            
-        debug_group = drw.g()
-        debug_group.add(marker_rect)
-        debug_group.add(margin_rect)
-        debug_group.add(center_line_h)
-        debug_group.add(center_line_v)
-        debug_group.add(name_baseline)
-        debug_group.add(label_middleline)
-        if x_pos == 'middle':
-            debug_group.add(label_centerline)
-        debug_group.add(label_rect)
-        drw.add(debug_group)
+    out_file = args.out_file
+    if out_file and os.path.exists(out_file) and (not args.force_overwrite):
+        input = input("output file '" + out_file + "' exists. overwrite? > ")
+        if input.upper() != 'YES':
+            print('bye.')
+            sys.exit(1)
 
-drw.save(pretty=True)
+    try:
+        annotator = Annotator(args.galaxies_json, args.style_json,
+                              index_file=args.index, opts=args, timer=timer)
+        geometry = annotator.write(args.wcs_fits, args.image_file, out_file,
+                                   timer)
+    finally:
+        if timer:
+            timer.close()
+    # stderr keeps '--stats -' output on stdout valid JSON.
+    print('tilt=', geometry['tilt'], file=sys.stderr)
+    print('scale=', geometry['scale'], file=sys.stderr)
+    if args.profile_startup:
+        timer.report()
+    if args.stats:
+        timer.write_json(args.stats)
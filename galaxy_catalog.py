@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""Galaxy catalogs for 'galaxy-annotator.py'.
+
+A catalog is either a galaxies.json file or a binary catalog file. The
+binary catalog is an uncompressed .npz file which is memory-mapped on
+load, so large catalogs can be used without parsing JSON:
+
+- galaxies: structured array of al2000, de2000, pa, logd25, logr25, mag
+  (NaN for null values, mag is missing in files of older versions).
+- name_text, name_offsets: UTF-8 names of galaxies and their offsets.
+- desc_text, desc_offsets: UTF-8 descs of all galaxies and their offsets.
+- desc_index: index of the first desc of each galaxy in desc_offsets.
+- style_text, style_offsets: per-galaxy style in JSON (empty if none).
+"""
+import sys
+import json
+import math
+import struct
+import zipfile
+
+BINARY_MAGIC = b'PK\x03\x04'
+COLUMNS = [ 'al2000', 'de2000', 'pa', 'logd25', 'logr25', 'mag' ]
+# columns which galaxies.json may omit.
+OPTIONAL_COLUMNS = [ 'mag' ]
+
+def float_or_nan(v):
+    return float(v) if not(v is None or v == '') else math.nan
+
+def none_if_nan(v):
+    v = float(v)
+    return None if math.isnan(v) else v
+
+class Catalog:
+    """Galaxies of galaxies.json.
+
+    Galaxies are accessed as dicts by index. Values of COLUMNS are also
+    available as NumPy arrays by column().
+    """
+    def __init__(self, galaxies):
+        self.galaxies = galaxies
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.galaxies)
+
+    def __getitem__(self, i):
+        return self.galaxies[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def column(self, name):
+        import numpy as np
+        if not(name in self.columns):
+            self.columns[name] = np.array([float_or_nan(gal.get(name))
+                                           for gal in self.galaxies],
+                                          dtype=float)
+        return self.columns[name]
+
+class BinaryCatalog(Catalog):
+    """Galaxies of a binary catalog file."""
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.arrays['galaxies'])
+
+    def _text(self, name, i):
+        offsets = self.arrays[name + '_offsets']
+        return bytes(self.arrays[name + '_text'][offsets[i]:offsets[i + 1]])\
+            .decode('utf-8')
+
+    def __getitem__(self, i):
+        rec = self.arrays['galaxies'][i]
+        gal = { 'name': self._text('name', i) }
+        for name in COLUMNS:
+            if name in OPTIONAL_COLUMNS:
+                if name in rec.dtype.names and not math.isnan(rec[name]):
+                    gal[name] = float(rec[name])
+            else:
+                gal[name] = none_if_nan(rec[name])
+        desc_index = self.arrays['desc_index']
+        gal['descs'] = [self._text('desc', j)
+                        for j in range(desc_index[i], desc_index[i + 1])]
+        s = self._text('style', i)
+        if s:
+            gal['style'] = json.loads(s)
+        return gal
+
+    def column(self, name):
+        import numpy as np
+        galaxies = self.arrays['galaxies']
+        if not(name in galaxies.dtype.names):
+            return np.full(len(galaxies), math.nan)
+        return galaxies[name]
+
+def load_npz_mmap(file):
+    """Memory-map arrays of an uncompressed .npz file."""
+    import numpy as np
+    arrays = {}
+    with zipfile.ZipFile(file) as z:
+        members = [ info for info in z.infolist() ]
+    with open(file, 'rb') as f:
+        for info in members:
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('{}: compressed member {} can not be '\
+                                 'mapped.'.format(file, info.filename))
+            f.seek(info.header_offset)
+            header = struct.unpack('<4s5H3L2H', f.read(30))
+            f.seek(info.header_offset + 30 + header[9] + header[10])
+            if np.lib.format.read_magic(f) == (1, 0):
+                read_array_header = np.lib.format.read_array_header_1_0
+            else:
+                read_array_header = np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_array_header(f)
+            name = info.filename[:-4] if info.filename.endswith('.npy') \
+                else info.filename
+            if math.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(file, dtype=dtype, mode='r',
+                                         offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    return arrays
+
+def is_binary_catalog(file):
+    with open(file, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+def load_catalog(file):
+    if is_binary_catalog(file):
+        return BinaryCatalog(load_npz_mmap(file))
+    with open(file, 'r', encoding='utf-8') as f:
+        return Catalog(json.load(f)['galaxies'])
+
+def _string_table(strings):
+    import numpy as np
+    encoded = [ s.encode('utf-8') for s in strings ]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([ len(b) for b in encoded ], dtype=np.int64)
+    text = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return text, offsets
+
+def write_binary_catalog(galaxies, file):
+    """Write galaxies (list of galaxy dicts) to file as a binary catalog."""
+    import numpy as np
+    records = np.zeros(len(galaxies),
+                       dtype=[ (name, 'f8') for name in COLUMNS ])
+    for name in COLUMNS:
+        records[name] = [ float_or_nan(gal.get(name)) for gal in galaxies ]
+    name_text, name_offsets = _string_table([ gal['name']
+                                              for gal in galaxies ])
+    descs = [ desc for gal in galaxies for desc in gal['descs'] ]
+    desc_text, desc_offsets = _string_table(descs)
+    desc_index = np.zeros(len(galaxies) + 1, dtype=np.int64)
+    desc_index[1:] = np.cumsum([ len(gal['descs']) for gal in galaxies ],
+                               dtype=np.int64)
+    style_text, style_offsets = _string_table([
+        json.dumps(gal['style'], ensure_ascii=False) if 'style' in gal else ''
+        for gal in galaxies ])
+    with open(file, 'wb') as f:
+        np.savez(f, galaxies=records,
+                 name_text=name_text, name_offsets=name_offsets,
+                 desc_text=desc_text, desc_offsets=desc_offsets,
+                 desc_index=desc_index,
+                 style_text=style_text, style_offsets=style_offsets)
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    argparser = ArgumentParser(description='Convert galaxies.json to binary '\
+                               "catalog for 'galaxy-annotator.py'.")
+    argparser.add_argument('galaxies_json', metavar='galaxies.json',
+                           help="input file (annotation data).")
+    argparser.add_argument('catalog', metavar='galaxies.npz',
+                           help="output file (binary catalog).")
+    argparser.add_argument("-f", "--force-overwrite", action="store_true",
+                           help="force overwriting to output file.")
+    args = argparser.parse_args()
+    import os.path
+    if (not args.force_overwrite) and os.path.exists(args.catalog):
+        input = input("output file '" + args.catalog +
+                      "' exists. overwrite? > ")
+        if input.upper() != 'YES':
+            print('bye.')
+            sys.exit()
+    catalog = load_catalog(args.galaxies_json)
+    write_binary_catalog(list(catalog), args.catalog)
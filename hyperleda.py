@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+"""HyperLeda queries for 'leda-get-votable.py'.
+
+A Query is a RA/Dec box (and optional magnitude limit) of galaxies. Results
+of queries (VOTable documents) are kept in a QueryCache directory:
+
+- index.json: query, size, creation time and last access time of entries.
+- <key>.xml: VOTable of each entry, where key is the SHA-1 of the
+  normalized 'where' clause and 'select' column list.
+
+A query is answered from an entry of the same key, or from an entry whose
+box and magnitude limit contain the query by filtering its rows.
+
+get_votable() gets the VOTable of galaxies in the field of view of a
+'wcs.fits' file like 'leda-get-votable.py'.
+"""
+import os
+import sys
+import re
+import json
+import time
+import hashlib
+import threading
+import urllib.parse
+import urllib.request
+
+# LEDA_URL = 'http://leda.univ-lyon1.fr/fG.cgi'
+LEDA_URL = 'http://atlas.obs-hp.fr/hyperleda/fG.cgi' # mirror
+
+SELECT = "pgc,objname,objtype,al1950,de1950,al2000,de2000,l2,b2,sgl,sgb,f_astrom,type,bar,ring,multiple,compactness,t,e_t,agnclass,logd25,e_logd25,logr25,e_logr25,pa,brief,e_brief,ut,e_ut,bt,e_bt,vt,e_vt,it,e_it,kt,e_kt,m21,e_m21,mfir,ube,bve,vmaxg,e_vmaxg,vmaxs,e_vmaxs,vdis,e_vdis,vrad,e_vrad,vopt,e_vopt,v,e_v,ag,ai,incl,a21,logdc,btc,itc,ubtc,bvtc,bri25,vrot,e_vrot,mg2,e_mg2,m21c,hic,vlg,vgsr,vvir,v3k,modz,e_modz,mod0,e_mod0,modbest,e_modbest,mabs,e_mabs,hl_names(pgc)"
+
+def cache_dir(subdir='hyperleda'):
+    """Cache directory of galaxy-annotator (subdir in it if subdir)."""
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    base = os.path.join(base, 'galaxy-annotator')
+    return os.path.join(base, subdir) if subdir else base
+
+class Query:
+    """Query of galaxies in RA (hours) / Dec (degrees) box."""
+    def __init__(self, ra_min, ra_max, dec_min, dec_max, max_mag=None,
+                 select=SELECT):
+        self.ra_min = ra_min
+        self.ra_max = ra_max
+        self.dec_min = dec_min
+        self.dec_max = dec_max
+        self.max_mag = max_mag
+        self.select = select
+
+    def where(self):
+        mag_where = ""
+        if self.max_mag:
+            mm = self.max_mag
+            mag_where = f"and (it<={mm} or vt<={mm} or bt<={mm})"
+        return f"al2000<{self.ra_max} and al2000>{self.ra_min} and de2000<{self.dec_max} and de2000>{self.dec_min} and objtype='G' {mag_where}"
+
+    def key(self):
+        normalized = ' '.join(self.where().split()) + '\n' + \
+            ','.join(c.strip() for c in self.select.split(','))
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+    def url(self, leda=LEDA_URL):
+        # http://atlas.obs-hp.fr/hyperleda/fG.cgi?n=meandata&c=o&of=1,leda,simbad&nra=l&nakd=1&sql=al2000%3C12.965687916818412%20and%20al2000%3E12.925228843825312%20and%20de2000%3C21.871941710192353%20and%20de2000%3E21.491211008587133%20and%20objtype%3D%27G%27&ob=&a=x
+        query = urllib.parse.urlencode({
+            'n': 'meandata',
+            'c': 'o',
+            'of': '1,leda,simbad',
+            'nra': 'l',
+            'nakd': '1',
+            'd': self.select,
+            'sql': self.where(),
+            'ob': '',
+            'a': 'x'
+        })
+        return "{leda}?{query}".format(leda=leda, query=query)
+
+    def to_dict(self):
+        return { 'ra_min': self.ra_min, 'ra_max': self.ra_max,
+                 'dec_min': self.dec_min, 'dec_max': self.dec_max,
+                 'max_mag': self.max_mag, 'select': self.select }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['ra_min'], d['ra_max'], d['dec_min'], d['dec_max'],
+                   d['max_mag'], d['select'])
+
+    def contains(self, other):
+        """True if all galaxies of other are in the result of this query."""
+        return self.select == other.select and \
+            self.ra_min <= other.ra_min and other.ra_max <= self.ra_max and \
+            self.dec_min <= other.dec_min and other.dec_max <= self.dec_max \
+            and (not self.max_mag or
+                 (other.max_mag and other.max_mag <= self.max_mag))
+
+    def match(self, values):
+        """True if a row (dict of column values in str) matches the query.
+
+        Values are compared as HyperLeda does (empty values never match)
+        but with the precision of values in VOTable.
+        """
+        def lt(name, v):
+            return values[name] != '' and float(values[name]) < v
+        def gt(name, v):
+            return values[name] != '' and float(values[name]) > v
+        if not(lt('al2000', self.ra_max) and gt('al2000', self.ra_min) and
+               lt('de2000', self.dec_max) and gt('de2000', self.dec_min)):
+            return False
+        if self.max_mag:
+            return any(values[name] != '' and
+                       float(values[name]) <= self.max_mag
+                       for name in ('it', 'vt', 'bt'))
+        return True
+
+FIELD_RE = re.compile(rb'<FIELD\s[^>]*?name="([^"]*)"')
+TR_RE = re.compile(rb'[ \t]*<TR>.*?</TR>[ \t]*\n?', re.S)
+TD_RE = re.compile(rb'<TD>(.*?)</TD>|<TD\s*/>', re.S)
+TABLE_ROWS_RE = re.compile(rb'(<INFO name="TableRows" value=")\d*(")')
+
+class VOTable:
+    """VOTable document split into head, rows (TR elements) and tail."""
+    def __init__(self, data):
+        start = data.find(b'<TABLEDATA>')
+        end = data.rfind(b'</TABLEDATA>')
+        if start < 0 or end < 0:
+            self.head, self.rows, self.tail = data, [], b''
+            self.fields = []
+            return
+        start += len(b'<TABLEDATA>')
+        matches = list(TR_RE.finditer(data, start, end))
+        if matches:
+            self.head = data[:matches[0].start()]
+            self.tail = data[matches[-1].end():]
+        else:
+            self.head = data[:end]
+            self.tail = data[end:]
+        self.rows = [ m.group(0) for m in matches ]
+        self.fields = [ f.decode('utf-8')
+                        for f in FIELD_RE.findall(data, 0, start) ]
+
+    def values(self, row):
+        """Values of a row as dict of str."""
+        cells = [ (m.group(1) or b'').decode('utf-8').strip()
+                  for m in TD_RE.finditer(row) ]
+        return dict(zip(self.fields, cells))
+
+    def value(self, row, name):
+        """Value of a column of a row."""
+        index = self.fields.index(name)
+        for i, m in enumerate(TD_RE.finditer(row)):
+            if i == index:
+                return (m.group(1) or b'').decode('utf-8').strip()
+        return ''
+
+    def column(self, name):
+        """Values of a column of all rows."""
+        return [ self.value(row, name) for row in self.rows ]
+
+    def tobytes(self, rows=None):
+        if rows is None:
+            rows = self.rows
+        head = TABLE_ROWS_RE.sub(lambda m: m.group(1) +
+                                 str(len(rows)).encode() + m.group(2),
+                                 self.head, count=1)
+        return head + b''.join(rows) + self.tail
+
+def merge_votables(results):
+    """Merge VOTables of queries removing duplicated galaxies by pgc.
+
+    Returns a tuple of merged VOTable, number of rows and number of removed
+    duplicates.
+    """
+    votables = [ VOTable(data) for data in results ]
+    base = next((v for v in votables if v.fields), votables[0])
+    rows = []
+    seen = set()
+    n_dups = 0
+    for votable in votables:
+        for row in votable.rows:
+            pgc = votable.value(row, 'pgc')
+            if pgc in seen:
+                n_dups += 1
+                continue
+            seen.add(pgc)
+            rows.append(row)
+    return base.tobytes(rows), len(rows), n_dups
+
+def footprint_mask(w, image_w, image_h, ra, dec, margin=0):
+    """Mask of galaxies at ra (hours) and dec (degrees) arrays in the image.
+
+    Galaxies are projected by WCS w at once, and those in the pixel bounds
+    of the image extended by margin pixels are selected (same as the
+    bounds used by 'galaxy-annotator.py' when margin is 0).
+    """
+    import numpy as np
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    if len(ra) == 0:
+        return np.zeros(0, dtype=bool)
+    x, y = w.world_to_pixel(SkyCoord(ra * u.hour, dec * u.deg))
+    return (x >= -margin) & (x <= image_w + margin) & \
+        (y >= -margin) & (y <= image_h + margin)
+
+def filter_footprint(data, w, image_w, image_h, margin=0):
+    """Remove rows of galaxies out of the image from VOTable data.
+
+    Returns a tuple of filtered VOTable, number of rows before and after
+    filtering.
+    """
+    votable = VOTable(data)
+    if not votable.rows:
+        return data, 0, 0
+    ra = [ float(v or 'nan') for v in votable.column('al2000') ]
+    dec = [ float(v or 'nan') for v in votable.column('de2000') ]
+    mask = footprint_mask(w, image_w, image_h, ra, dec, margin)
+    rows = [ row for row, inside in zip(votable.rows, mask) if inside ]
+    return votable.tobytes(rows), len(votable.rows), len(rows)
+
+def is_valid_result(data):
+    return b'name="QUERY_STATUS" value="OK"' in data
+
+def fetch(query, leda=LEDA_URL):
+    """Get VOTable of query from HyperLeda (or compatible server)."""
+    req = urllib.request.Request(query.url(leda))
+    with urllib.request.urlopen(req) as res:
+        return res.read()
+
+class QueryCache:
+    """On-disk cache of query results with LRU eviction and TTL."""
+    INDEX = 'index.json'
+
+    def __init__(self, dir, max_size=256*1024*1024, ttl=7*24*60*60):
+        self.dir = dir
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.index = {}
+        index_file = os.path.join(dir, self.INDEX)
+        if os.path.exists(index_file):
+            try:
+                with open(index_file, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+            except ValueError:
+                self.index = {}
+
+    def _file(self, key):
+        return os.path.join(self.dir, key + '.xml')
+
+    def _save_index(self):
+        os.makedirs(self.dir, exist_ok=True)
+        index_file = os.path.join(self.dir, self.INDEX)
+        with open(index_file + '.part', 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(index_file + '.part', index_file)
+
+    def _remove(self, key):
+        del self.index[key]
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def _read(self, key, now):
+        try:
+            with open(self._file(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._remove(key)
+            return None
+        self.index[key]['atime'] = now
+        return data
+
+    def _expire(self, now):
+        for key in [ key for key, entry in self.index.items()
+                     if now - entry['ctime'] > self.ttl ]:
+            self._remove(key)
+
+    def get(self, query):
+        """VOTable of query from cache, or None if not cached.
+
+        Returns a pair of data and the kind of hit ('exact' or 'superset').
+        """
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            key = query.key()
+            data = None
+            hit = None
+            if key in self.index:
+                data = self._read(key, now)
+                hit = 'exact'
+            if data is None:
+                supersets = sorted(
+                    (entry['size'], k) for k, entry in self.index.items()
+                    if Query.from_dict(entry['query']).contains(query))
+                for size, k in supersets:
+                    data = self._read(k, now)
+                    if data is not None:
+                        votable = VOTable(data)
+                        data = votable.tobytes([
+                            row for row in votable.rows
+                            if query.match(votable.values(row)) ])
+                        hit = 'superset'
+                        break
+            self._save_index()
+            return data, hit
+
+    def put(self, query, data):
+        if not is_valid_result(data):
+            return
+        now = time.time()
+        with self.lock:
+            os.makedirs(self.dir, exist_ok=True)
+            key = query.key()
+            with open(self._file(key) + '.part', 'wb') as f:
+                f.write(data)
+            os.replace(self._file(key) + '.part', self._file(key))
+            self.index[key] = { 'query': query.to_dict(), 'size': len(data),
+                                'ctime': now, 'atime': now }
+            self._expire(now)
+            lru = sorted(self.index, key=lambda k: self.index[k]['atime'])
+            total = sum(entry['size'] for entry in self.index.values())
+            for k in lru:
+                if total <= self.max_size or k == key:
+                    break
+                total -= self.index[k]['size']
+                self._remove(k)
+            self._save_index()
+
+def load_field(wcs_fits):
+    """Load WCS (astropy) and image size of the 'wcs.fits' file output by
+    astrometry.net. Returns a tuple of WCS, image width and height."""
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    hdu = fits.open(wcs_fits)[0]
+    w = WCS(hdu.header, fix=False)
+    return w, hdu.header['IMAGEW'], hdu.header['IMAGEH']
+
+def field_box(w, image_w, image_h):
+    """RA (hours) / Dec (degrees) box which contains the image. Returns a
+    tuple of ra_min, ra_max, dec_min and dec_max (ra_min is negative if
+    the box crosses 0h)."""
+    import warnings
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+    sky_top_left = w.pixel_to_world(0, 0)
+    sky_top_right = w.pixel_to_world(image_w, 0)
+    sky_bottom_left = w.pixel_to_world(0, image_h)
+    sky_bottom_right = w.pixel_to_world(image_w, image_h)
+    sky_center = w.pixel_to_world(image_w/2, image_h/2)
+
+    def hit_test(x, y):
+        return (x >= 0 and x < image_w) and (y >= 0 and y < image_h)
+
+    def ra_min_max(ra_left, ra_right):
+        # 写野に極が入らないと仮定
+        # センターを挟んで対角線を辿って前後のRAの差の符号が食い違うなら
+        if ((ra_left > sky_center.ra.hour) ^ (sky_center.ra.hour > ra_right)):
+            # 0h をまたいでいるので大きい方のRAから24h引いてマイナスにする
+            ra_min = max(ra_left, ra_right) - 24
+            ra_max = min(ra_left, ra_right)
+        else:
+            ra_max = max(ra_left, ra_right)
+            ra_min = min(ra_left, ra_right)
+        return ra_min, ra_max
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', category=RuntimeWarning)
+        warnings.filterwarnings('ignore', category=UserWarning)
+        px, py = w.world_to_pixel(SkyCoord(0*u.hour, 90.0*u.deg))
+        spx, spy = w.world_to_pixel(SkyCoord(0*u.hour, -90.0*u.deg))
+
+    decs = [ sky_top_left.dec.degree, sky_top_right.dec.degree,
+             sky_bottom_left.dec.degree, sky_bottom_right.dec.degree ]
+    if hit_test(px, py):
+        # 写野に天の北極がある場合
+        return 0.0, 24.0, min(decs), 90.0
+    elif hit_test(spx, spy):
+        # 写野に天の南極がある場合
+        return 0.0, 24.0, -90.0, max(decs)
+    ra_min1, ra_max1 = ra_min_max(sky_top_left.ra.hour,
+                                  sky_bottom_right.ra.hour)
+    ra_min2, ra_max2 = ra_min_max(sky_bottom_left.ra.hour,
+                                  sky_top_right.ra.hour)
+    return min(ra_min1, ra_min2), max(ra_max1, ra_max2), min(decs), max(decs)
+
+def tile_queries(w, image_w, image_h, box, tile_size, max_mag=None, n=4):
+    """Queries of tiles of about tile_size degrees which overlap the image
+    in the RA/Dec box."""
+    import math
+    import numpy as np
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+    ra_min, ra_max, dec_min, dec_max = box
+    # 写野を含む RA/Dec の範囲を大きさ tile_size 度程度の RA/Dec の矩形に分割し、
+    # 写野と重なるものだけを検索する
+    eps = 1e-7
+    queries = []
+    # 写野の周上の点
+    t = np.linspace(0, 1, 256, endpoint=False)
+    edge_x = np.concatenate([ image_w * t, np.full_like(t, image_w),
+                              image_w * (1 - t), np.zeros_like(t) ])
+    edge_y = np.concatenate([ np.zeros_like(t), image_h * t,
+                              np.full_like(t, image_h), image_h * (1 - t) ])
+    edge = w.pixel_to_world(edge_x, edge_y)
+    edge_ra = (edge.ra.hour - ra_min) % 24 + ra_min
+    edge_dec = edge.dec.degree
+    def bounds(lo, hi, n):
+        # 境界の銀河を落とさないよう内側の境界だけ eps 広げ、外周は box に揃える
+        # (box の検索結果のキャッシュがタイルを含むように)
+        b = [ lo + (hi - lo) * k / n for k in range(n) ] + [ hi ]
+        return [ (b[k] - eps if k else lo, b[k + 1] + eps if k < n - 1 else hi)
+                 for k in range(n) ]
+
+    n_dec = max(1, math.ceil((dec_max - dec_min) / tile_size))
+    for d0, d1 in bounds(dec_min, dec_max, n_dec):
+        cos_dec = 1.0 if d0 <= 0 <= d1 else \
+            max(math.cos(math.radians(d0)), math.cos(math.radians(d1)))
+        n_ra = max(1, math.ceil((ra_max - ra_min) * 15 * cos_dec / tile_size))
+        for r0, r1 in bounds(ra_min, ra_max, n_ra):
+            # 矩形内の点が写野に入るか、写野の周上の点が矩形に入るなら重なる
+            gr, gd = np.meshgrid(np.linspace(r0, r1, n + 1),
+                                 np.linspace(d0, d1, n + 1))
+            x, y = w.world_to_pixel(SkyCoord(gr.ravel() * u.hour,
+                                             gd.ravel() * u.deg))
+            inside = (x >= 0) & (x < image_w) & (y >= 0) & (y < image_h)
+            on_edge = (edge_ra >= r0) & (edge_ra <= r1) & \
+                (edge_dec >= d0) & (edge_dec <= d1)
+            if np.any(inside) or np.any(on_edge):
+                queries.append(Query(r0, r1, d0, d1, max_mag))
+    return queries
+
+def field_queries(w, image_w, image_h, max_mag=None, tile_size=None):
+    """Queries of galaxies in the image (one query of the whole box, or
+    queries of tiles if tile_size)."""
+    box = field_box(w, image_w, image_h)
+    if tile_size:
+        return tile_queries(w, image_w, image_h, box, tile_size, max_mag)
+    return [ Query(*box, max_mag) ]
+
+def get_votables(queries, leda=LEDA_URL, cache=None, offline=False,
+                 fetch_jobs=4):
+    """Get results of queries from cache or HyperLeda (concurrently by
+    fetch_jobs threads). Raises LookupError if offline and a query is not
+    in cache."""
+    def get_votable(query):
+        data = None
+        if cache:
+            data, hit = cache.get(query)
+            if data is not None:
+                print(f"cache: {hit} hit.", file=sys.stderr)
+        if data is None:
+            if offline:
+                return None
+            data = fetch(query, leda or LEDA_URL)
+            if cache:
+                cache.put(query, data)
+        return data
+
+    if len(queries) == 1:
+        results = [ get_votable(queries[0]) ]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=fetch_jobs) as executor:
+            results = list(executor.map(get_votable, queries))
+    if None in results:
+        raise LookupError("no cached result for the query.")
+    return results
+
+def get_votable(wcs_fits, max_mag=None, tile_size=None, fetch_jobs=4,
+                footprint_filter=False, margin=0, leda=LEDA_URL, cache=None,
+                offline=False):
+    """Get VOTable (bytes) of galaxies in the field of view of wcs_fits
+    (library version of 'leda-get-votable.py')."""
+    w, image_w, image_h = load_field(wcs_fits)
+    queries = field_queries(w, image_w, image_h, max_mag, tile_size)
+    results = get_votables(queries, leda, cache, offline, fetch_jobs)
+    if len(results) == 1:
+        data = results[0]
+    else:
+        data, n_rows, n_dups = merge_votables(results)
+        print(f"tiles: {len(results)}, rows: {n_rows} "\
+              f"({n_dups} duplicates removed).", file=sys.stderr)
+    if footprint_filter:
+        data, n_rows, n_inside = filter_footprint(data, w, image_w, image_h,
+                                                  margin)
+        print(f"footprint filter: {n_inside} of {n_rows} rows in the image.",
+              file=sys.stderr)
+    return data
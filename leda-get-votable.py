@@ -16,6 +16,35 @@ argparser.add_argument("-f", "--force-overwrite", action="store_true",
                        help="force overwriting to output file.")
 argparser.add_argument("--dry-run", dest="dryrun", action="store_true",
                        help="force overwriting to output file.")
+argparser.add_argument("--leda-url", dest="leda_url", default=None,
+                       help="URL of HyperLeda (or compatible server) to "\
+                       "query.", metavar="URL")
+argparser.add_argument("--cache-dir", dest="cache_dir", default=None,
+                       help="directory of query cache (default: "\
+                       "~/.cache/galaxy-annotator/hyperleda).", metavar="DIR")
+argparser.add_argument("--no-cache", dest="cache", action="store_false",
+                       help="don't use query cache.")
+argparser.add_argument("--offline", action="store_true",
+                       help="don't query HyperLeda, only use query cache.")
+argparser.add_argument("--cache-size", dest="cache_size", type=float,
+                       default=256, help="maximum size of query cache in MB "\
+                       "(default: 256).", metavar="MB")
+argparser.add_argument("--cache-ttl", dest="cache_ttl", type=float,
+                       default=7, help="days to keep query cache "\
+                       "(default: 7).", metavar="DAYS")
+argparser.add_argument("-t", "--tile-size", dest="tile_size", type=float,
+                       help="split the field of view into tiles of about "\
+                       "DEG degrees and query them concurrently.",
+                       metavar="DEG")
+argparser.add_argument("-J", "--fetch-jobs", dest="fetch_jobs", type=int,
+                       default=4, help="number of concurrent queries for "\
+                       "tiles (default: 4).", metavar="N")
+argparser.add_argument("-F", "--footprint-filter", dest="footprint_filter",
+                       action="store_true",
+                       help="output only galaxies in the image (and margin).")
+argparser.add_argument("--margin", type=float, default=0,
+                       help="margin of the image in pixels for "\
+                       "--footprint-filter (default: 0).", metavar="PX")
 args = argparser.parse_args()
 if not args.wcs_fits:
     argparser.print_help(sys.stderr)
@@ -29,107 +58,32 @@ if args.votable_xml:
             print('bye.')
             sys.exit()
     
-import json
-import urllib.request
-from astropy import units as u
-from astropy.io import fits
-from astropy.wcs import WCS
-from astropy.coordinates import SkyCoord
-
-hdu = fits.open(args.wcs_fits)[0]
-w = WCS(hdu.header, fix=False)
-image_w = hdu.header['IMAGEW']
-image_h = hdu.header['IMAGEH']
-
-sky_top_left = w.pixel_to_world(0, 0)
-sky_top_right = w.pixel_to_world(image_w, 0)
-sky_bottom_left = w.pixel_to_world(0, image_h)
-sky_bottom_right = w.pixel_to_world(image_w, image_h)
-sky_center = w.pixel_to_world(image_w/2, image_h/2)
-
-def hit_test(x, y):
-    return (x >= 0 and x < image_w) and (y >= 0 and y < image_h)
-
-def ra_min_max(ra_left, ra_right):
-    # 写野に極が入らないと仮定
-    # センターを挟んで対角線を辿って前後のRAの差の符号が食い違うなら
-    if ((ra_left > sky_center.ra.hour) ^ (sky_center.ra.hour > ra_right)):
-        # 0h をまたいでいるので大きい方のRAから24h引いてマイナスにする
-        ra_min = max(ra_left, ra_right) - 24
-        ra_max = min(ra_left, ra_right)
-    else:
-        ra_max = max(ra_left, ra_right)
-        ra_min = min(ra_left, ra_right)
-    return ra_min, ra_max
-
-ra_min = None
-ra_max = None
-dec_min = None
-dec_max = None
-
-import warnings
-warnings.filterwarnings('ignore', category=RuntimeWarning)
-warnings.filterwarnings('ignore', category=UserWarning)
-px, py = w.world_to_pixel(SkyCoord(0*u.hour, 90.0*u.deg))
-spx, spy = w.world_to_pixel(SkyCoord(0*u.hour, -90.0*u.deg))
-warnings.filterwarnings('default', category=RuntimeWarning)
-warnings.filterwarnings('default', category=UserWarning)
-
-if hit_test(px, py):
-    # 写野に天の北極がある場合
-    dec_min = min(sky_top_left.dec.degree, sky_top_right.dec.degree,
-                  sky_bottom_left.dec.degree, sky_bottom_right.dec.degree)
-    dec_max = 90.0
-    ra_min = 0.0
-    ra_max = 24.0
-elif hit_test(spx, spy):
-    # 写野に天の南極がある場合
-    dec_min = -90.0
-    dec_max = max(sky_top_left.dec.degree, sky_top_right.dec.degree,
-                  sky_bottom_left.dec.degree, sky_bottom_right.dec.degree)
-    ra_min = 0.0
-    ra_max = 24.0
-else:    
-    ra_min1, ra_max1 = ra_min_max(sky_top_left.ra.hour, sky_bottom_right.ra.hour)
-    ra_min2, ra_max2 = ra_min_max(sky_bottom_left.ra.hour, sky_top_right.ra.hour)
-    ra_min = min(ra_min1, ra_min2)
-    ra_max = max(ra_max1, ra_max2)
-    dec_min = min(sky_top_left.dec.degree, sky_top_right.dec.degree,
-                  sky_bottom_left.dec.degree, sky_bottom_right.dec.degree)
-    dec_max = max(sky_top_left.dec.degree, sky_top_right.dec.degree,
-                  sky_bottom_left.dec.degree, sky_bottom_right.dec.degree)
-
-mag_where = ""
-if args.max_mag:
-    mm = args.max_mag
-    mag_where = f"and (it<={mm} or vt<={mm} or bt<={mm})"
-
-where = f"al2000<{ra_max} and al2000>{ra_min} and de2000<{dec_max} and de2000>{dec_min} and objtype='G' {mag_where}"
+import hyperleda
 
 if args.dryrun:
-    print(f"WHERE {where}")
+    w, image_w, image_h = hyperleda.load_field(args.wcs_fits)
+    for query in hyperleda.field_queries(w, image_w, image_h, args.max_mag,
+                                         args.tile_size):
+        print(f"WHERE {query.where()}")
     exit(0)
 
-select = "pgc,objname,objtype,al1950,de1950,al2000,de2000,l2,b2,sgl,sgb,f_astrom,type,bar,ring,multiple,compactness,t,e_t,agnclass,logd25,e_logd25,logr25,e_logr25,pa,brief,e_brief,ut,e_ut,bt,e_bt,vt,e_vt,it,e_it,kt,e_kt,m21,e_m21,mfir,ube,bve,vmaxg,e_vmaxg,vmaxs,e_vmaxs,vdis,e_vdis,vrad,e_vrad,vopt,e_vopt,v,e_v,ag,ai,incl,a21,logdc,btc,itc,ubtc,bvtc,bri25,vrot,e_vrot,mg2,e_mg2,m21c,hic,vlg,vgsr,vvir,v3k,modz,e_modz,mod0,e_mod0,modbest,e_modbest,mabs,e_mabs,hl_names(pgc)"
+cache = None
+if args.cache or args.offline:
+    cache = hyperleda.QueryCache(args.cache_dir or hyperleda.cache_dir(),
+                                 int(args.cache_size * 1024 * 1024),
+                                 args.cache_ttl * 24 * 60 * 60)
 
-# leda = 'http://leda.univ-lyon1.fr/fG.cgi'
-leda = 'http://atlas.obs-hp.fr/hyperleda/fG.cgi' # mirror
-# http://atlas.obs-hp.fr/hyperleda/fG.cgi?n=meandata&c=o&of=1,leda,simbad&nra=l&nakd=1&sql=al2000%3C12.965687916818412%20and%20al2000%3E12.925228843825312%20and%20de2000%3C21.871941710192353%20and%20de2000%3E21.491211008587133%20and%20objtype%3D%27G%27&ob=&a=x
-query = urllib.parse.urlencode({
-    'n': 'meandata',
-    'c': 'o',
-    'of': '1,leda,simbad',
-    'nra': 'l',
-    'nakd': '1',
-    'd': select,
-    'sql': where,
-    'ob': '',
-    'a': 'x'
-})
-req = urllib.request.Request("{leda}?{query}".format(leda=leda, query=query))
-with urllib.request.urlopen(req) as res:
-    if args.votable_xml:
-        with open(args.votable_xml, 'wb') as out:
-            out.write(res.read())
-    else:
-        sys.stdout.buffer.write(res.read())
+try:
+    data = hyperleda.get_votable(args.wcs_fits, args.max_mag, args.tile_size,
+                                 args.fetch_jobs, args.footprint_filter,
+                                 args.margin, args.leda_url, cache,
+                                 args.offline)
+except LookupError as e:
+    print(e, file=sys.stderr)
+    exit(1)
+
+if args.votable_xml:
+    with open(args.votable_xml, 'wb') as out:
+        out.write(data)
+else:
+    sys.stdout.buffer.write(data)
@@ -0,0 +1,38 @@
+import os
+import os.path
+import sys
+import json
+import subprocess
+import tempfile
+import unittest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class RasterTest(unittest.TestCase):
+    def test_css_units(self):
+        # lengths and percentages accepted by SVG are drawn in PNG too.
+        with open(os.path.join(BASE_DIR, 'sample-style.json'),
+                  encoding='utf-8') as f:
+            style = json.load(f)
+        style['marker'].update({ 'stroke-width': '3px',
+                                 'stroke-opacity': '50%',
+                                 'opacity': '80%' })
+        style['name']['fill-opacity'] = 'invalid'
+        with tempfile.TemporaryDirectory() as tmp:
+            style_json = os.path.join(tmp, 'style.json')
+            with open(style_json, 'w', encoding='utf-8') as f:
+                json.dump(style, f)
+            out_png = os.path.join(tmp, 'out.png')
+            subprocess.run(
+                [ sys.executable,
+                  os.path.join(BASE_DIR, 'galaxy-annotator.py'), '-f',
+                  os.path.join(BASE_DIR, 'sample-galaxies.json'), style_json,
+                  os.path.join(BASE_DIR, 'test-data', 'test-wcs.fits'),
+                  os.path.join(BASE_DIR, 'test-data', 'test-in.jpg'),
+                  out_png ],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+            with open(out_png, 'rb') as f:
+                self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+
+if __name__ == '__main__':
+    unittest.main()
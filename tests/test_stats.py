@@ -0,0 +1,45 @@
+import os
+import os.path
+import sys
+import json
+import subprocess
+import tempfile
+import unittest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class StatsTest(unittest.TestCase):
+    def run_stats(self, *options):
+        """Run 'galaxy-annotator.py --stats -' with options and return the
+        parsed stats and stderr."""
+        with tempfile.TemporaryDirectory() as tmp:
+            options = [ o.format(tmp=tmp) for o in options ]
+            proc = subprocess.run(
+                [ sys.executable,
+                  os.path.join(BASE_DIR, 'galaxy-annotator.py'),
+                  '-f', '--stats', '-' ] + options +
+                [ os.path.join(BASE_DIR, 'sample-galaxies.json'),
+                  os.path.join(BASE_DIR, 'sample-style.json'),
+                  os.path.join(BASE_DIR, 'test-data', 'test-wcs.fits'),
+                  os.path.join(BASE_DIR, 'test-data', 'test-in.jpg'),
+                  os.path.join(tmp, 'out.svg') ],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        stats = json.loads(proc.stdout.decode('utf-8'))
+        self.assertIn('stages', stats)
+        self.assertGreater(stats['total']['time'], 0)
+        return stats, proc.stderr
+
+    def test_stats_stdout_is_json(self):
+        stats, err = self.run_stats()
+        self.assertIn(b'tilt=', err)
+
+    def test_stats_with_lod(self):
+        stats, err = self.run_stats('--lod', '1')
+        self.assertIn(b'lod: ', err)
+
+    def test_stats_with_index(self):
+        stats, err = self.run_stats('--index', '{tmp}/index.npz')
+        self.assertIn(b'index: saved', err)
+
+if __name__ == '__main__':
+    unittest.main()
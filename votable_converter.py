@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+"""Conversion of VOTABLE of HyperLeda to galaxies.json.
+
+Library of 'leda-votable-to-galaxy.py'. Converter converts rows of a
+VOTABLE file to galaxy dicts of galaxies.json by the same options as the
+command line options of the script:
+
+    from votable_converter import Converter
+    converter = Converter(max_mag=17.5, calc_distance=True, japanese=True)
+    galaxies = list(converter.iter_galaxies('votable.xml'))
+
+convert_votable() writes them to galaxies.json (or a binary catalog).
+"""
+import os
+import sys
+import re
+import json
+import math
+import xml.etree.ElementTree as et
+from decimal import Decimal, ROUND_HALF_UP
+
+CATALOGUES = [ 'M', 'NGC', 'IC', 'PGC' ]
+CATALOGUE_PATTERNS = {
+    'M': r'(MESSIER)(\d+)()',
+    'NGC': r'(NGC)(\d+)([A-Z]?)',
+    'IC': r'(IC)(\d+)([A-Z]?)',
+    'PGC': r'(PGC)(\d+)([A-Z]?)'
+}
+
+class ConversionError(ValueError):
+    pass
+
+def float_or_none(v):
+    return float(v) if v else None
+
+class NameResolver:
+    """Resolves the name of a galaxy from hl_names in one pass.
+
+    A single regular expression of the alternation of the catalogues in
+    resolve_order matches whole names (stripped of whitespace) in the
+    comma separated hl_names. The index of the alternative that matched
+    is the priority of the catalogue, so the first name of the catalogue of
+    the highest priority wins.
+    """
+    def __init__(self, resolve_order=CATALOGUES):
+        # unknown catalogues are ignored.
+        self.catalogues = [ cat for cat in resolve_order
+                            if cat in CATALOGUE_PATTERNS ]
+        self.pattern = None
+        if self.catalogues:
+            self.pattern = re.compile(r'(?:^|,)\s*(?:{})\s*(?=,|$)'.format(
+                '|'.join(CATALOGUE_PATTERNS[cat] for cat in self.catalogues)))
+
+    def __call__(self, hl_names):
+        """Name of the galaxy (zero suppressed) or None."""
+        if self.pattern is None:
+            return None
+        best = None
+        for m in self.pattern.finditer(hl_names):
+            # groups of the alternative that matched are not None.
+            rank = (m.lastindex - 1) // 3
+            if best is None or rank < best[0]:
+                best = (rank, m)
+                if rank == 0:
+                    break
+        if best is None:
+            return None
+        rank, m = best
+        number, suffix = m.group(rank * 3 + 2, rank * 3 + 3)
+        # the catalogue names are the prefixes of the output ('M' for
+        # 'MESSIER').
+        return self.catalogues[rank] + str(int(number)) + suffix
+
+class DistanceTable:
+    """Interpolation tables of luminosity distance and lookback distance.
+
+    The distances are sampled by astropy at N redshifts evenly spaced in
+    log(z) between Z_MIN and Z_MAX and interpolated linearly in log-log
+    space. The maximum relative errors against astropy measured at the
+    midpoints of the samples are kept in z_error and lookback_error
+    (about 2e-8 for the cosmology used here). Values out of the tables are
+    calculated by astropy. Tables are cached in cache_dir by cosmological
+    parameters.
+    """
+    Z_MIN = 1e-7
+    Z_MAX = 20.0
+    N = 200000
+    VERSION = 1
+
+    def __init__(self, cosmo, cache_dir=None):
+        import hashlib
+        import numpy as np
+        self.cosmo = cosmo
+        key = '{} H0={} Om0={} Ode0={} Tcmb0={} z={}-{} n={} v{}'.format(
+            type(cosmo).__name__, cosmo.H0.value, cosmo.Om0, cosmo.Ode0,
+            cosmo.Tcmb0.value, self.Z_MIN, self.Z_MAX, self.N, self.VERSION)
+        cache_file = None
+        if cache_dir:
+            cache_file = os.path.join(cache_dir, 'distance-{}.npz'.format(
+                hashlib.sha1(key.encode()).hexdigest()[:16]))
+        if cache_file and os.path.exists(cache_file):
+            with np.load(cache_file) as data:
+                if str(data['key']) == key:
+                    self.ln_z = data['ln_z']
+                    self.ln_ld = data['ln_ld']
+                    self.ln_lookback = data['ln_lookback']
+                    self.z_error = float(data['z_error'])
+                    self.lookback_error = float(data['lookback_error'])
+                    return
+        self.build()
+        if cache_file:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(cache_file, 'wb') as f:
+                    np.savez(f, key=key, ln_z=self.ln_z, ln_ld=self.ln_ld,
+                             ln_lookback=self.ln_lookback,
+                             z_error=self.z_error,
+                             lookback_error=self.lookback_error)
+            except OSError:
+                pass
+
+    def _ln_distances(self, z):
+        import numpy as np
+        from astropy import units as u
+        return (np.log(self.cosmo.luminosity_distance(z).to_value(u.Mpc)),
+                np.log(self.cosmo.lookback_distance(z).to_value(u.lyr)))
+
+    def build(self):
+        import numpy as np
+        self.ln_z = np.linspace(math.log(self.Z_MIN), math.log(self.Z_MAX),
+                                self.N)
+        self.ln_ld, self.ln_lookback = self._ln_distances(np.exp(self.ln_z))
+        ln_z_mid = (self.ln_z[1:] + self.ln_z[:-1]) / 2
+        ln_ld_mid, ln_lookback_mid = self._ln_distances(np.exp(ln_z_mid))
+        z_mid = np.interp(ln_ld_mid, self.ln_ld, self.ln_z)
+        lookback_mid = np.interp(ln_z_mid, self.ln_z, self.ln_lookback)
+        self.z_error = float(np.max(np.abs(np.expm1(z_mid - ln_z_mid))))
+        self.lookback_error = float(np.max(np.abs(
+            np.expm1(lookback_mid - ln_lookback_mid))))
+
+    def z_at_luminosity_distance(self, ld):
+        """Redshifts at luminosity distances ld in Mpc."""
+        import numpy as np
+        from astropy import units as u
+        from astropy.cosmology import z_at_value
+        ln_ld = np.log(ld)
+        z = np.exp(np.interp(ln_ld, self.ln_ld, self.ln_z))
+        for i in np.flatnonzero((ln_ld < self.ln_ld[0]) |
+                                (ln_ld > self.ln_ld[-1])):
+            z[i] = z_at_value(self.cosmo.luminosity_distance,
+                              ld[i] * u.Mpc).value
+        return z
+
+    def lookback_distance_lyr(self, z):
+        """Lookback distances in light years at redshifts z."""
+        import numpy as np
+        from astropy import units as u
+        d = np.exp(np.interp(np.log(z), self.ln_z, self.ln_lookback))
+        out = (z < self.Z_MIN) | (z > self.Z_MAX)
+        if np.any(out):
+            d[out] = self.cosmo.lookback_distance(z[out]).to_value(u.lyr)
+        return d
+
+class ExactDistance:
+    """Distances calculated by astropy for each value."""
+    def __init__(self, cosmo):
+        self.cosmo = cosmo
+
+    def z_at_luminosity_distance(self, ld):
+        import numpy as np
+        from astropy import units as u
+        from astropy.cosmology import z_at_value
+        return np.array([z_at_value(self.cosmo.luminosity_distance,
+                                    v * u.Mpc).value for v in ld])
+
+    def lookback_distance_lyr(self, z):
+        from astropy import units as u
+        return self.cosmo.lookback_distance(z).to_value(u.lyr)
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def iter_records(votable_xml):
+    # read rows one by one and discard them, not to keep whole VOTABLE in
+    # memory.
+    fields = []
+    tabledata = None
+    for event, elem in et.iterparse(votable_xml, events=('start', 'end')):
+        tag = local_name(elem.tag)
+        if event == 'start':
+            if tag == 'TABLEDATA':
+                tabledata = elem
+        elif tag == 'FIELD':
+            fields.append(elem.attrib['name'])
+        elif tag == 'TR':
+            rec = {}
+            tds = filter(lambda e: local_name(e.tag) == 'TD', elem)
+            for i, f in enumerate(tds):
+                rec[fields[i]] = f.text
+            yield rec
+            tabledata.clear()
+
+class GalaxiesJSONWriter:
+    """Writes galaxies.json incrementally.
+
+    The output is the same as json.dumps({ "galaxies": galaxies }, indent=2,
+    ensure_ascii=False). Output to a file goes to a temporary file which
+    replaces the file on close() or is removed on abort().
+    """
+    def __init__(self, file=None):
+        self.file = file
+        if file:
+            self.tmp_file = file + '.part'
+            self.out = open(self.tmp_file, 'w', encoding='utf-8')
+        else:
+            self.out = sys.stdout
+        self.count = 0
+
+    def write(self, gal):
+        self.write_formatted(format_galaxy(gal))
+
+    def write_formatted(self, text):
+        """Write a galaxy formatted by format_galaxy()."""
+        self.out.write(',\n' if self.count else '{\n  "galaxies": [\n')
+        self.out.write(text)
+        self.count += 1
+
+    def close(self):
+        self.out.write('\n  ]\n}' if self.count else '{\n  "galaxies": []\n}')
+        if self.file:
+            self.out.close()
+            os.replace(self.tmp_file, self.file)
+            self.file = None
+        else:
+            self.out.write('\n')
+
+    def abort(self):
+        if self.file:
+            self.out.close()
+            os.remove(self.tmp_file)
+            self.file = None
+
+def magnitude(rec):
+    it = rec['it']
+    if it == None:
+        it = rec['vt']
+    if it == None:
+        it = rec['bt']
+    return it
+
+CHUNK_SIZE = 10000
+
+def iter_chunks(records):
+    chunk = []
+    for rec in records:
+        chunk.append(rec)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+XML_DECL_RE = re.compile(rb'\s*<\?xml\s[^>]*\?>')
+FIELD_RE = re.compile(rb'<FIELD\s[^>]*?name="([^"]*)"')
+BLOCK_SIZE = 4 * 1024 * 1024
+
+def iter_tabledata_chunks(votable_xml, chunk_size=CHUNK_SIZE):
+    """Split TABLEDATA of votable_xml (path or binary file object) into
+    chunks of chunk_size rows (the same chunks as iter_chunks()) without
+    parsing rows. Yields (fields, prolog, data) where data is the text of
+    the rows to be parsed by parse_tabledata_chunk()."""
+    f = open(votable_xml, 'rb') if isinstance(votable_xml, str) \
+        else votable_xml
+    try:
+        buf = f.read(BLOCK_SIZE)
+        m = XML_DECL_RE.match(buf)
+        # XML declaration for the encoding of the rows.
+        prolog = m.group(0).strip() if m else b''
+        fields = []
+        eof = False
+        while True:
+            # find the next TABLEDATA and FIELDs before it.
+            start = buf.find(b'<TABLEDATA>')
+            while start < 0 and not eof:
+                block = f.read(BLOCK_SIZE)
+                eof = not block
+                buf += block
+                start = buf.find(b'<TABLEDATA>')
+            if start < 0:
+                return
+            fields += [ name.decode('utf-8')
+                        for name in FIELD_RE.findall(buf, 0, start) ]
+            buf = buf[start + len(b'<TABLEDATA>'):]
+            # end of the last row and number of rows of the current chunk.
+            pos = 0
+            rows = 0
+            scan = 0
+            while True:
+                end = buf.find(b'</TABLEDATA>', scan)
+                limit = end if end >= 0 else len(buf)
+                while True:
+                    tr_end = buf.find(b'</TR>', pos, limit)
+                    if tr_end < 0:
+                        break
+                    pos = tr_end + len(b'</TR>')
+                    rows += 1
+                    if rows == chunk_size:
+                        yield list(fields), prolog, buf[:pos]
+                        buf = buf[pos:]
+                        limit -= pos
+                        end = end - pos if end >= 0 else end
+                        pos = 0
+                        rows = 0
+                if end >= 0:
+                    if rows:
+                        yield list(fields), prolog, buf[:pos]
+                    buf = buf[end + len(b'</TABLEDATA>'):]
+                    break
+                if eof:
+                    raise et.ParseError('no end of TABLEDATA')
+                # the end tag of the table can be split by blocks.
+                scan = max(pos, len(buf) - len(b'</TABLEDATA>') + 1)
+                block = f.read(BLOCK_SIZE)
+                eof = not block
+                buf += block
+    finally:
+        if f is not votable_xml:
+            f.close()
+
+def parse_tabledata_chunk(fields, prolog, data):
+    """Records of a chunk of iter_tabledata_chunks() (the same as
+    iter_records())."""
+    table = et.fromstring(prolog + b'<TABLEDATA>' + data + b'</TABLEDATA>')
+    records = []
+    for tr in table:
+        if local_name(tr.tag) != 'TR':
+            continue
+        rec = {}
+        tds = filter(lambda e: local_name(e.tag) == 'TD', tr)
+        for i, f in enumerate(tds):
+            rec[fields[i]] = f.text
+        records.append(rec)
+    return records
+
+def format_galaxy(gal):
+    """Text of gal in galaxies.json written by GalaxiesJSONWriter."""
+    s = json.dumps(gal, indent=2, ensure_ascii=False)
+    return '    ' + s.replace('\n', '\n    ')
+
+chunk_converter = None
+
+def init_chunk_worker(converter):
+    global chunk_converter
+    chunk_converter = converter
+
+def convert_tabledata_chunk(fields, prolog, data, format=None):
+    """Convert a chunk of iter_tabledata_chunks() by the converter of the
+    worker. Returns galaxies (formatted by format if given) and messages to
+    stderr, which are printed by the parent in the order of chunks."""
+    import io
+    import contextlib
+    err = io.StringIO()
+    with contextlib.redirect_stderr(err):
+        galaxies = chunk_converter.convert_chunk(
+            parse_tabledata_chunk(fields, prolog, data))
+    if format:
+        galaxies = [ format(gal) for gal in galaxies ]
+    return galaxies, err.getvalue()
+
+class Converter:
+    """Converts records of VOTABLE to galaxy dicts.
+
+    Options are the same as the command line options of
+    'leda-votable-to-galaxy.py' (resolve_order is a list of catalogues and
+    footprint is the path of a wcs.fits file). Records without magnitude
+    raise ConversionError unless skip_error or ignore_error.
+    """
+    def __init__(self, max_mag=None, skip_error=False, ignore_error=False,
+                 calc_distance=False, japanese=False, distance_precision=3,
+                 compat_distance_precision=False, use_mod0=True,
+                 exact_distance=False,
+                 show_negative_redshift_description=False,
+                 resolve_order=CATALOGUES, with_magnitude=False,
+                 footprint=None, margin=0):
+        self.max_mag = max_mag
+        self.skip_error = skip_error
+        self.ignore_error = ignore_error
+        self.calc_distance = calc_distance
+        self.japanese = japanese
+        self.distance_precision = distance_precision
+        self.compat_distance_precision = compat_distance_precision
+        self.use_mod0 = use_mod0
+        self.show_negative_redshift_description = \
+            show_negative_redshift_description
+        self.resolve_order = list(resolve_order)
+        self.resolve_name = NameResolver(self.resolve_order)
+        self.with_magnitude = with_magnitude
+        self.margin = margin
+        self.distance = None
+        if calc_distance:
+            from astropy.cosmology import LambdaCDM
+            cosmo = LambdaCDM(H0=67.3, Om0=0.315, Ode0=0.685)
+            if exact_distance:
+                self.distance = ExactDistance(cosmo)
+            else:
+                from hyperleda import cache_dir
+                self.distance = DistanceTable(cosmo, cache_dir(None))
+        self.footprint = None
+        if footprint:
+            import warnings
+            from astropy.io import fits
+            from astropy.wcs import WCS
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                header = fits.getheader(footprint)
+                self.footprint = (WCS(header, fix=False), header['IMAGEW'],
+                                  header['IMAGEH'])
+
+    def magnitude_ok(self, rec):
+        it = magnitude(rec)
+        if it == None:
+            if self.skip_error:
+                return False
+            elif self.ignore_error:
+                it = -100.0
+            else:
+                raise ConversionError("no magnitude data for '{}'.".format(
+                    rec['objname']))
+        return float(it) <= self.max_mag
+
+    def format_distance(self, d_ly):
+        d_str = ''
+        exp = math.ceil(math.log10(d_ly) - self.distance_precision)
+        if self.compat_distance_precision:
+            # 精度に関わらず最低100万光年までの精度で表示。
+            exp = min(exp, 6)
+        exp_param = Decimal('1E'+str(exp))
+        d_ly_r = Decimal(d_ly).quantize(exp_param, rounding=ROUND_HALF_UP)
+        if self.japanese:
+            oku = math.floor(d_ly_r / 100000000)
+            man = (d_ly_r - oku * 100000000) / 10000
+            if oku > 0:
+                d_str += str(oku) + '億'
+                if man > 0:
+                    d_str += str(man) + '万'
+            else:
+                d_str += str(man) + '万'
+            d_str += '光年'
+        else:
+            d_str = str(d_ly_r / 1000000000) + ' Gly'
+        return d_str
+
+    def distance_descs(self, recs):
+        # calculate distances of all records at once.
+        import numpy as np
+        z = np.full(len(recs), np.nan)
+        mod0 = np.array([float(rec['mod0']) if self.use_mod0 and rec['mod0']
+                         else np.nan for rec in recs])
+        use_mod0 = ~np.isnan(mod0)
+        z[use_mod0] = self.distance.z_at_luminosity_distance(
+            10 ** (0.2 * mod0[use_mod0] - 5))
+        for i, rec in enumerate(recs):
+            if not use_mod0[i] and rec['v']:
+                z[i] = float(rec['v']) / 299792.458
+        d_ly = np.full(len(recs), np.nan)
+        d_ly[z >= 0] = self.distance.lookback_distance_lyr(z[z >= 0])
+
+        descs_list = []
+        for i, rec in enumerate(recs):
+            descs = []
+            if z[i] >= 0:
+                descs.append(self.format_distance(float(d_ly[i])))
+            elif not np.isnan(z[i]):
+                print("WARN: negative redshift value found for '{}' "\
+                      "(z={}).".format(rec['objname'], float(z[i])),
+                      file=sys.stderr)
+                if self.show_negative_redshift_description:
+                    descs.append("z={}".format(float(z[i])))
+            descs_list.append(descs)
+        return descs_list
+
+    def galaxy_name(self, rec):
+        name = self.resolve_name(rec['hl_names'])
+        if name != None:
+            return name
+        return f"{rec['objname']}(PGC{rec['pgc']})"
+
+    def convert_chunk(self, chunk):
+        """Convert a list of records to a list of galaxy dicts."""
+        if self.footprint:
+            from hyperleda import footprint_mask
+            w, image_w, image_h = self.footprint
+            mask = footprint_mask(w, image_w, image_h,
+                                  [ float(rec['al2000']) for rec in chunk ],
+                                  [ float(rec['de2000']) for rec in chunk ],
+                                  self.margin)
+            chunk = [ rec for rec, inside in zip(chunk, mask) if inside ]
+        if self.max_mag:
+            chunk = list(filter(self.magnitude_ok, chunk))
+        if self.calc_distance:
+            descs_list = self.distance_descs(chunk)
+        else:
+            descs_list = [ [] for rec in chunk ]
+
+        galaxies = []
+        for rec, descs in zip(chunk, descs_list):
+            gal = {
+                "name": self.galaxy_name(rec),
+                "al2000": float(rec['al2000']),
+                "de2000": float(rec['de2000']),
+                "pa": float_or_none(rec['pa']),
+                "logd25": float_or_none(rec['logd25']),
+                "logr25": float_or_none(rec['logr25'])
+            }
+            if self.with_magnitude:
+                gal["mag"] = float_or_none(magnitude(rec))
+            gal["descs"] = descs
+            galaxies.append(gal)
+        return galaxies
+
+    def iter_galaxies(self, votable_xml, jobs=1):
+        """Yield galaxy dicts of votable_xml (path or file object)."""
+        for galaxies in self.iter_converted_chunks(votable_xml, jobs):
+            yield from galaxies
+
+    def iter_converted_chunks(self, votable_xml, jobs=1, format=None):
+        """Yield lists of galaxy dicts (or texts formatted by format) of
+        chunks of votable_xml in the order of rows. If jobs > 1, rows are
+        parsed and converted by jobs worker processes with the same results
+        as in this process."""
+        if jobs <= 1:
+            for chunk in iter_chunks(iter_records(votable_xml)):
+                galaxies = self.convert_chunk(chunk)
+                if format:
+                    galaxies = [ format(gal) for gal in galaxies ]
+                yield galaxies
+            return
+        from collections import deque
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs,
+                                       initializer=init_chunk_worker,
+                                       initargs=(self,))
+        try:
+            # chunks are read ahead while 2 * jobs chunks are waiting.
+            pending = deque()
+            chunks = iter_tabledata_chunks(votable_xml)
+            while True:
+                for chunk in chunks:
+                    pending.append(executor.submit(convert_tabledata_chunk,
+                                                   *chunk, format))
+                    if len(pending) >= 2 * jobs:
+                        break
+                if not pending:
+                    break
+                galaxies, err = pending.popleft().result()
+                sys.stderr.write(err)
+                yield galaxies
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+def convert_votable(votable_xml, galaxies_json=None, jobs=1, **options):
+    """Convert votable_xml to galaxies_json (galaxies.json or binary catalog
+    by extension '.npz', standard output if None) with options of
+    Converter by jobs processes. Returns the number of galaxies."""
+    converter = Converter(**options)
+    if galaxies_json and galaxies_json.endswith('.npz'):
+        from galaxy_catalog import write_binary_catalog
+        galaxies = list(converter.iter_galaxies(votable_xml, jobs))
+        write_binary_catalog(galaxies, galaxies_json)
+        return len(galaxies)
+    writer = GalaxiesJSONWriter(galaxies_json)
+    try:
+        for texts in converter.iter_converted_chunks(votable_xml, jobs,
+                                                     format_galaxy):
+            for text in texts:
+                writer.write_formatted(text)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.count